@@ -0,0 +1,184 @@
+import os
+import argparse
+import threading
+import metrics
+from dotenv import load_dotenv
+from db_pool import get_cursor
+from vector_writer import to_vector
+from pgconf_utils import OPENAI_LLM_MODEL, UBICLOUD_LLM_MODEL, OPENAI_VECTOR_DIMENSIONS, UBICLOUD_VECTOR_DIMENSIONS
+
+load_dotenv()
+# Set ANSWER_CACHE=0 to always retrieve and ask
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") != "0"
+# Largest cosine distance between two questions' embeddings for the answer to
+# one to be given to the other. Questions about different things in mostly the
+# same words are often within 0.05, so only near-identical wordings match.
+ANSWER_CACHE_DISTANCE = float(os.getenv("ANSWER_CACHE_DISTANCE", "0.02"))
+# Hours an answer is kept, and entries kept at most; beyond that the least
+# recently used go first
+ANSWER_CACHE_TTL_HOURS = float(os.getenv("ANSWER_CACHE_TTL_HOURS", "168"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+# Binary-quantized candidates reranked by full distance for Ubicloud vectors
+ANSWER_CACHE_CANDIDATES = 10
+
+LLM_MODELS = {"openai": OPENAI_LLM_MODEL, "ubicloud": UBICLOUD_LLM_MODEL}
+VECTOR_DIMENSIONS = {"openai": OPENAI_VECTOR_DIMENSIONS,
+                     "ubicloud": UBICLOUD_VECTOR_DIMENSIONS}
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+_iterative_scan = None
+
+
+def answer_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def context_key(context_types, settings=None):
+    """
+    The key of an answer's context: its types, and the retrieval settings
+    (search mode, top_k, ef_search, probes) that were not left unset.
+    """
+    key = ",".join(sorted(context_types))
+    for name, value in sorted((settings or {}).items()):
+        if value is not None:
+            key += f";{name}={value}"
+    return key
+
+
+def iterative_scan(cur):
+    """
+    Whether the server's pgvector (0.8 or later) can go on with a filtered
+    HNSW scan past ef_search. Checked once per process.
+    """
+    global _iterative_scan
+    if _iterative_scan is None:
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cur.fetchone()
+        version = tuple(int(part) for part in row[0].split(".")[:2]) if row else (0, 0)
+        _iterative_scan = version >= (0, 8)
+    return _iterative_scan
+
+
+def nearest_sql(provider):
+    """
+    Selects the closest fresh entry within ANSWER_CACHE_DISTANCE of
+    %(vector)s. Ubicloud vectors are too wide to index, so their nearest
+    entries by Hamming distance are reranked by cosine distance.
+    """
+    if provider == "openai":
+        order = "vector_openai <=> %(vector)s"
+    else:
+        dimensions = VECTOR_DIMENSIONS[provider]
+        order = f"binary_quantize(vector_ubicloud)::bit({dimensions}) <~> binary_quantize(%(vector)s::vector)"
+    return f"""
+        SELECT "id", distance
+        FROM (
+            SELECT "id", vector_{provider} <=> %(vector)s AS distance
+            FROM answer_cache
+            WHERE "provider" = %(provider)s AND "model" = %(model)s AND "repo" = %(repo)s
+              AND "context_types" = %(context_types)s AND "indexed_at" = %(indexed_at)s
+              AND "created_at" > now() - %(ttl_hours)s * interval '1 hour'
+            ORDER BY {order}
+            LIMIT %(candidates)s
+        ) candidates
+        WHERE distance <= %(distance)s
+        ORDER BY distance
+        LIMIT 1
+    """
+
+
+def lookup(provider, repo, context_types, vector, settings=None):
+    """
+    Returns the (question, prompt, answer) cached for the question nearest to
+    `vector`, or None, and the repo's current indexed_at, which a new answer
+    is stored under. Entries answered from an older index or with other
+    retrieval `settings` are not used.
+    """
+    if not ANSWER_CACHE:
+        return None, None
+
+    with metrics.span("answer_cache_lookup", provider=provider) as span, get_cursor() as cur:
+        cur.execute("""SELECT "indexed_at" FROM repos WHERE "name" = %s""", (repo,))
+        row = cur.fetchone()
+        if row is None:
+            return None, None
+        indexed_at = row[0]
+        # Filtered HNSW scans go on past ef_search until enough rows match
+        if iterative_scan(cur):
+            cur.execute("SET LOCAL hnsw.iterative_scan = relaxed_order")
+        cur.execute(f"""
+            WITH hit AS ({nearest_sql(provider)})
+            UPDATE answer_cache c SET "hits" = c."hits" + 1, "used_at" = now()
+            FROM hit WHERE c."id" = hit."id"
+            RETURNING c."question", c."prompt", c."answer"
+        """, {"provider": provider, "model": LLM_MODELS[provider], "repo": repo,
+              "context_types": context_key(context_types, settings), "indexed_at": indexed_at,
+              "vector": to_vector(vector), "ttl_hours": ANSWER_CACHE_TTL_HOURS,
+              "candidates": ANSWER_CACHE_CANDIDATES, "distance": ANSWER_CACHE_DISTANCE})
+        hit = cur.fetchone()
+        span.add(rows=int(hit is not None))
+    with _stats_lock:
+        _stats["hits" if hit else "misses"] += 1
+    return hit, indexed_at
+
+
+def store(provider, repo, context_types, indexed_at, question, vector, prompt, answer, settings=None):
+    """
+    Caches `answer` under the indexed_at returned by lookup, then evicts the
+    repo's entries from older indexes, expired entries, and the least
+    recently used beyond ANSWER_CACHE_MAX_ENTRIES.
+    """
+    if not ANSWER_CACHE or indexed_at is None or not answer:
+        return
+
+    with get_cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO answer_cache ("provider", "model", "repo", "context_types", "indexed_at",
+                                      "question", "vector_{provider}", "prompt", "answer")
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (provider, LLM_MODELS[provider], repo, context_key(context_types, settings), indexed_at,
+                     question, to_vector(vector), prompt, answer))
+        cur.execute("""
+            DELETE FROM answer_cache
+            WHERE ("repo" = %s AND "indexed_at" < %s)
+               OR "created_at" <= now() - %s * interval '1 hour'
+               OR "id" IN (SELECT "id" FROM answer_cache ORDER BY "used_at" DESC OFFSET %s)""",
+                    (repo, indexed_at, ANSWER_CACHE_TTL_HOURS, ANSWER_CACHE_MAX_ENTRIES))
+
+
+def clear(repo=None):
+    with get_cursor() as cur:
+        if repo:
+            cur.execute("""DELETE FROM answer_cache WHERE "repo" = %s""", (repo,))
+        else:
+            cur.execute("DELETE FROM answer_cache")
+        return cur.rowcount
+
+
+def print_stats():
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT c."repo", c."provider", count(*), sum(c."hits"),
+                   count(*) FILTER (WHERE c."indexed_at" IS DISTINCT FROM r."indexed_at")
+            FROM answer_cache c LEFT JOIN repos r ON r."name" = c."repo"
+            GROUP BY 1, 2 ORDER BY 1, 2""")
+        for repo, provider, entries, hits, stale in cur.fetchall():
+            print(f"{repo} ({provider}): {entries} answers ({stale} from an older index), {hits} hits")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Inspect or clear cached answers to questions.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats")
+    clear_parser = subparsers.add_parser("clear")
+    clear_parser.add_argument("--repo", help="Only clear the answers about this repo.")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print_stats()
+    else:
+        deleted = clear(args.repo)
+        print(f"Deleted {deleted} cached answers.")
@@ -1,16 +1,105 @@
+import os
+import asyncio
+import functools
 import gradio as gr
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from ask_question import ask_question
+import answer_cache
+from ask_question import get_prompt, question_embedding_async, retrieval_settings, stream_answer_async
+from db_pool import get_cursor
 
 load_dotenv()
-
-
-def chat_with_context(provider, repo, question, context_types):
-    return ask_question(provider, repo, question, context_types, return_prompt=True)
-
-
-def chat_without_context(provider, repo, question):
-    return ask_question(provider, repo, question, [])
+# Submissions answered at once, and submissions waiting beyond that before new
+# ones are turned away
+APP_CONCURRENCY_LIMIT = int(os.getenv("APP_CONCURRENCY_LIMIT", "16"))
+APP_QUEUE_SIZE = int(os.getenv("APP_QUEUE_SIZE", "64"))
+PROVIDERS = ["openai", "ubicloud"]
+
+# Retrieval is blocking; each submission runs it for both providers at once.
+# The answers stream, and Ubicloud questions are embedded, over the providers'
+# async clients.
+executor = ThreadPoolExecutor(max_workers=2 * APP_CONCURRENCY_LIMIT)
+
+
+def indexed_repos():
+    with get_cursor() as cur:
+        cur.execute('SELECT "name" FROM repos ORDER BY "name"')
+        return [name for name, in cur.fetchall()]
+
+
+def repo_choices():
+    """
+    Lists the repositories indexed so far, read again on every page load.
+    """
+    choices = indexed_repos()
+    return gr.Radio(choices=choices, value=choices[0] if choices else None)
+
+
+def cached_note(cached_question):
+    return f"*Cached answer to: {cached_question}*\n\n---\n\n"
+
+
+@metrics.timed("submission")
+async def answer_all(repo, question, context_types):
+    """
+    Answers a submission in every panel: both providers without context, and
+    with the context retrieved once per provider, all streamed concurrently.
+    Answers with context to questions asked before come from the answer
+    cache, marked as such. Yields the contents of the six panels each time any of them changes.
+    """
+    loop = asyncio.get_running_loop()
+    # Answers without context, answers with context, then the prompts
+    panels = [""] * 6
+    updates = asyncio.Queue()
+
+    async def answer(index, provider, context_types):
+        try:
+            if not context_types:
+                # Answers without context are quick to start and not cached
+                prompt = get_prompt(provider, repo, question, [])
+                async for answer in stream_answer_async(provider, prompt):
+                    updates.put_nowait((index, answer))
+                return
+            settings = retrieval_settings(provider, context_types)
+            vector = await question_embedding_async(provider, question)
+            hit, indexed_at = await loop.run_in_executor(
+                executor, answer_cache.lookup, provider, repo, context_types, vector, settings)
+            if hit:
+                cached_question, prompt, answer = hit
+                updates.put_nowait((index + 2, prompt))
+                updates.put_nowait((index, cached_note(cached_question) + answer))
+                return
+            prompt = await loop.run_in_executor(executor, functools.partial(
+                get_prompt, provider, repo, question, context_types, vector=vector))
+            updates.put_nowait((index + 2, prompt))
+            answer = ""
+            async for answer in stream_answer_async(provider, prompt):
+                updates.put_nowait((index, answer))
+            await loop.run_in_executor(executor, answer_cache.store, provider, repo, context_types,
+                                       indexed_at, question, vector, prompt, answer, settings)
+        except Exception as e:
+            updates.put_nowait((index, f"Error: {e}"))
+        finally:
+            updates.put_nowait((None, None))
+
+    tasks = [asyncio.create_task(answer(i, provider, []))
+             for i, provider in enumerate(PROVIDERS)]
+    tasks += [asyncio.create_task(answer(2 + i, provider, context_types))
+              for i, provider in enumerate(PROVIDERS)]
+    remaining = len(tasks)
+    while remaining:
+        index, value = await updates.get()
+        # Apply everything that arrived meanwhile before redrawing
+        while True:
+            if index is None:
+                remaining -= 1
+            else:
+                panels[index] = value
+            if updates.empty():
+                break
+            index, value = updates.get_nowait()
+        yield tuple(panels)
 
 
 # Define the Gradio interface.
@@ -18,8 +107,8 @@ with gr.Blocks() as demo:
     gr.Markdown("# Chat Interface with Ubicloud and OpenAI")
 
     # First row: Repository selection
-    repo = gr.Radio(["pg_cron", "citus", "postgres"],
-                    label="Select Repository", value="pg_cron", interactive=True)
+    repo = gr.Radio([], label="Select Repository", interactive=True)
+    demo.load(repo_choices, outputs=repo)
 
     # Second row: Question input
     question = gr.Textbox(
@@ -27,7 +116,7 @@ with gr.Blocks() as demo:
 
     # Third row: Context types selection
     context_types = gr.CheckboxGroup(
-        ["files", "folders", "commits"], label="Select Context Types", value=["files"], interactive=True)
+        ["files", "chunks", "folders", "commits"], label="Select Context Types", value=["files"], interactive=True)
 
     # Fourth row: Create a grid layout for the response panels.
     with gr.Row():
@@ -75,58 +164,19 @@ with gr.Blocks() as demo:
     # Submit button to call the respective functions
     submit_btn = gr.Button("Ask")
 
-    # Function calls for each of the output panels
-    submit_btn.click(
-        fn=lambda repo, question: chat_without_context(
-            "openai", repo, question),
-        inputs=[repo, question],
-        outputs=output_openai_no_context
-    )
-    submit_btn.click(
-        fn=lambda repo, question: chat_without_context(
-            "ubicloud", repo, question),
-        inputs=[repo, question],
-        outputs=output_ubicloud_no_context
-    )
-    submit_btn.click(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "openai", repo, question, context_types),
-        inputs=[repo, question, context_types],
-        outputs=[output_openai_with_context, output_openai_with_context_prompt]
-    )
-    submit_btn.click(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "ubicloud", repo, question, context_types),
+    # One handler per submission fills every panel
+    gr.on(
+        triggers=[submit_btn.click, question.submit],
+        fn=answer_all,
         inputs=[repo, question, context_types],
-        outputs=[output_ubicloud_with_context,
-                 output_ubicloud_with_context_prompt]
+        outputs=[output_openai_no_context, output_ubicloud_no_context,
+                 output_openai_with_context, output_ubicloud_with_context,
+                 output_openai_with_context_prompt, output_ubicloud_with_context_prompt],
+        concurrency_limit=APP_CONCURRENCY_LIMIT,
     )
 
-    question.submit(
-        fn=lambda repo, question: chat_without_context(
-            "openai", repo, question),
-        inputs=[repo, question],
-        outputs=output_openai_no_context
-    )
-    question.submit(
-        fn=lambda repo, question: chat_without_context(
-            "ubicloud", repo, question),
-        inputs=[repo, question],
-        outputs=output_ubicloud_no_context
-    )
-    question.submit(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "openai", repo, question, context_types),
-        inputs=[repo, question, context_types],
-        outputs=[output_openai_with_context, output_openai_with_context_prompt]
-    )
-    question.submit(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "ubicloud", repo, question, context_types),
-        inputs=[repo, question, context_types],
-        outputs=[output_ubicloud_with_context,
-                 output_ubicloud_with_context_prompt]
-    )
+# Prometheus scrapes the stage histograms from METRICS_PORT
+metrics.start_server()
 
 # Launch the Gradio app.
-demo.launch()
+demo.queue(max_size=APP_QUEUE_SIZE).launch()
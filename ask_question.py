@@ -1,105 +1,395 @@
 import os
+import re
 import sys
+import asyncio
 import numpy as np
-from pgvector.psycopg2 import register_vector
-import psycopg2
+import metrics
+import answer_cache
 from dotenv import load_dotenv
-from contextlib import contextmanager
-from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding, ask_openai, ask_ubicloud
+from context_packer import pack_context, CONTEXT_TOKEN_BUDGETS, PACK_OVERFETCH
+from db_pool import get_cursor, execute_prepared
+from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding, generate_ubicloud_embedding_async, ask_openai, ask_ubicloud, ask_openai_stream_async, ask_ubicloud_stream_async, OPENAI_VECTOR_DIMENSIONS, UBICLOUD_VECTOR_DIMENSIONS
 
 # Load environment variables
 load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
 
+VECTOR_DIMENSIONS = {"openai": OPENAI_VECTOR_DIMENSIONS,
+                     "ubicloud": UBICLOUD_VECTOR_DIMENSIONS}
+# Ubicloud vectors are too wide for a vector index, so they are searched
+# through their binary quantization and reranked by default.
+SEARCH_MODES = {
+    "openai": os.getenv("OPENAI_SEARCH_MODE", "exact"),
+    "ubicloud": os.getenv("UBICLOUD_SEARCH_MODE", "binary"),
+}
+# Number of binary candidates fetched per requested result before reranking
+RERANK_OVERFETCH = int(os.getenv("RERANK_OVERFETCH", "4"))
 
-@contextmanager
-def get_cursor():
-    conn = psycopg2.connect(DATABASE_URL)
-    register_vector(conn)
-    cur = conn.cursor()
-    try:
-        yield cur
-    finally:
-        cur.close()
-        conn.close()
+# Types of the prepared retrieval statement parameters; the row counts
+# (top_k, candidates) are ints
+SEARCH_PARAM_TYPES = {"repo": "text", "vector": "vector", "query": "text", "query_not": "text"}
 
+# Tables with a full-text "search" column. In "hybrid" mode their vector and
+# full-text rankings are fused; other tables are searched by vector only.
+LEXICAL_TABLES = {"files", "commits", "file_chunks"}
+# Reciprocal rank fusion constant: a row scores 1 / (RRF_K + rank) in each
+# ranking it appears in, so lower values favour the top ranks more
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Full-text matches ranked at most per table; ranking reads each match's whole
+# "search" column, so only this many, found through its GIN index, are ranked
+LEXICAL_PREFILTER = int(os.getenv("LEXICAL_PREFILTER", "1000"))
 
-def query_files(provider, repo, vector, top_k=5):
-    FETCH_FILES = f"""
-        SELECT "name", "code", "folder", llm_{provider}
-        FROM files 
-        WHERE repo = %s
-        ORDER BY vector_{provider} <-> %s
-        LIMIT %s
+# Columns returned per context type, in the order the prompt builder unpacks
+# them. Context types read the table of the same name, except chunks. The
+# line numbers are cast so every type's columns are text and can be unioned.
+CONTEXT_COLUMNS = {
+    "folders": ['"name"', 'llm_{provider}'],
+    "files": ['"name"', '"folder"', 'llm_{provider}'],
+    "commits": ['"repo"', '"id"', 'llm_{provider}'],
+    "chunks": ['"name"', '"folder"', '"start_line"::text', '"end_line"::text', '"code"', 'llm_{provider}'],
+}
+CONTEXT_TABLES = {"chunks": "file_chunks"}
+
+
+def set_search_params(cur, ef_search=None, probes=None):
+    # SET LOCAL only lasts for the current transaction, i.e. this query
+    if ef_search is not None:
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (int(ef_search),))
+    if probes is not None:
+        cur.execute("SET LOCAL ivfflat.probes = %s", (int(probes),))
+
+
+def vector_search_sql(table, columns, provider, search_mode="exact", param_prefix="", limit="top_k"):
     """
-    if type(vector) == list:
-        vector = np.array(vector)
-    with get_cursor() as cur:
-        cur.execute(FETCH_FILES, (repo, vector, top_k))
-        files = cur.fetchall()
-        return files
+    Builds a repo-filtered nearest neighbour query over vector_<provider>.
+
+    "exact" orders rows by the full vector. "binary" first fetches
+    %(candidates)s rows by Hamming distance on the binary-quantized index,
+    then reranks only those on the full vector. `param_prefix` namespaces the
+    top_k and candidates parameters so several searches can share a statement,
+    and `limit` names the one that limits the results.
+    """
+    top_k = f"%({param_prefix}{limit})s"
+    candidates = f"%({param_prefix}candidates)s"
+    if search_mode == "exact":
+        return f"""
+            SELECT {columns}
+            FROM {table}
+            WHERE repo = %(repo)s
+            ORDER BY vector_{provider} <-> %(vector)s
+            LIMIT {top_k}
+        """
+    if search_mode == "binary":
+        dimensions = VECTOR_DIMENSIONS[provider]
+        return f"""
+            SELECT {columns}
+            FROM (
+                SELECT {columns}, vector_{provider}
+                FROM {table}
+                WHERE repo = %(repo)s
+                ORDER BY binary_quantize(vector_{provider})::bit({dimensions}) <~> binary_quantize(%(vector)s::vector)
+                LIMIT {candidates}
+            ) candidates
+            ORDER BY vector_{provider} <-> %(vector)s
+            LIMIT {top_k}
+        """
+    raise ValueError("Invalid search mode. Must be 'exact' or 'binary'.")
 
 
-def query_folders(provider, repo, vector, top_k=5):
-    FETCH_FOLDERS = f"""
-        SELECT "name", llm_{provider}
-        FROM folders 
-        WHERE repo = %s
-        ORDER BY vector_{provider} <-> %s
-        LIMIT %s
+def hybrid_search_sql(table, columns, provider, vector_mode, param_prefix=""):
     """
-    if type(vector) == list:
-        vector = np.array(vector)
-    with get_cursor() as cur:
-        cur.execute(FETCH_FOLDERS, (repo, vector, top_k))
-        folders = cur.fetchall()
-        return folders
+    Builds a repo-filtered query that fuses the vector ranking of
+    vector_search_sql in `vector_mode` with the full-text ranking of
+    %(query)s, both cut at %(candidates)s rows, by reciprocal rank fusion.
+    Any word or phrase of %(query)s may match, but none of %(query_not)s
+    (see lexical_terms); rows matching more of it, or in their name rather
+    than their code, rank higher. At most LEXICAL_PREFILTER matches are ranked.
+    """
+    top_k = f"%({param_prefix}top_k)s"
+    candidates = f"%({param_prefix}candidates)s"
+    vector_search = vector_search_sql(table, "ctid", provider, vector_mode,
+                                      param_prefix, limit="candidates")
+    return f"""
+        SELECT {columns}
+        FROM {table}
+        JOIN (
+            SELECT row_id, sum(1.0 / ({RRF_K} + rank)) AS score
+            FROM (
+                SELECT ctid AS row_id, row_number() OVER () AS rank
+                FROM ({vector_search}) vector_ranked
+                UNION ALL
+                SELECT * FROM (
+                    SELECT row_id, row_number() OVER (ORDER BY ts_rank_cd("search", query) DESC) AS rank
+                    FROM (
+                        SELECT ctid AS row_id, "search", query
+                        FROM {table}, (SELECT websearch_to_tsquery('english', %(query)s)
+                                              && !! websearch_to_tsquery('english', %(query_not)s) AS query) q
+                        WHERE repo = %(repo)s AND "search" @@ query
+                        LIMIT {LEXICAL_PREFILTER}
+                    ) matched
+                    ORDER BY rank
+                    LIMIT {candidates}
+                ) text_ranked
+            ) ranked
+            GROUP BY row_id
+        ) fused ON {table}.ctid = fused.row_id
+        -- ctids are only unique within a partition
+        WHERE {table}.repo = %(repo)s
+        ORDER BY fused.score DESC
+        LIMIT {top_k}
+    """
+
+
+def search_sql(table, columns, provider, search_mode, param_prefix=""):
+    if search_mode == "hybrid":
+        if table in LEXICAL_TABLES:
+            return hybrid_search_sql(table, columns, provider, SEARCH_MODES[provider], param_prefix)
+        search_mode = SEARCH_MODES[provider]
+    return vector_search_sql(table, columns, provider, search_mode, param_prefix)
+
 
+def context_columns(table, provider, with_vectors=False):
+    columns = [column.format(provider=provider) for column in CONTEXT_COLUMNS[table]]
+    if with_vectors:
+        columns.append(f"vector_{provider} AS context_vector")
+    return columns
 
-def query_commits(provider, repo, vector, top_k=5):
-    FETCH_COMMITS = f"""
-        SELECT "repo", "id", llm_{provider}
-        FROM commits 
-        WHERE repo = %s
-        ORDER BY vector_{provider} <-> %s
-        LIMIT %s
+
+def execute_search(cur, name, query, params):
+    for i, param in enumerate(params):
+        query = query.replace(f"%({param})s", f"${i + 1}")
+    param_types = [SEARCH_PARAM_TYPES.get(param, "int") for param in params]
+    execute_prepared(cur, name, param_types, query, list(params.values()))
+
+
+def lexical_terms(query_text):
+    """
+    Splits a question in websearch syntax into the words and quoted phrases
+    a row may match any of, and the -excluded ones, each joined with "or"
+    for websearch_to_tsquery.
     """
+    terms, excluded = [], []
+    for term in re.findall(r'-?"[^"]*"?|\S+', query_text):
+        if term.lower() == "or":
+            continue
+        if term.startswith("-") and len(term) > 1:
+            excluded.append(term[1:])
+        else:
+            terms.append(term)
+    return " or ".join(terms), " or ".join(excluded)
+
+
+def search_params(repo, vector, search_mode, query_text):
     if type(vector) == list:
         vector = np.array(vector)
-    with get_cursor() as cur:
-        cur.execute(FETCH_COMMITS, (repo, vector, top_k))
-        commits = cur.fetchall()
-        return commits
+    params = {"repo": repo, "vector": vector}
+    if search_mode == "hybrid":
+        if query_text is None:
+            raise ValueError("Hybrid search needs the query text.")
+        params["query"], params["query_not"] = lexical_terms(query_text)
+    return params
 
 
-def get_prompt(provider: str, repo: str, question: str, context_types) -> str:
-    if provider not in ["openai", "ubicloud"]:
-        raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
+def query_vectors(table, provider, repo, vector, top_k, ef_search, probes, search_mode, query_text=None, with_vectors=False):
+    search_mode = search_mode or SEARCH_MODES[provider]
+    columns = ", ".join(context_columns(table, provider, with_vectors))
+    query = search_sql(CONTEXT_TABLES.get(table, table), columns, provider, search_mode)
+    params = search_params(repo, vector, search_mode, query_text)
+    params.update({"top_k": top_k, "candidates": top_k * RERANK_OVERFETCH})
+    with metrics.span("query", table=table, provider=provider, mode=search_mode) as span, get_cursor() as cur:
+        set_search_params(cur, ef_search, probes)
+        execute_search(cur, f"fetch_{table}_{provider}_{search_mode}{'_vectors' if with_vectors else ''}",
+                       query, params)
+        rows = cur.fetchall()
+        span.add(rows=len(rows))
+        return rows
+
+
+def query_files(provider, repo, vector, top_k=5, ef_search=None, probes=None, search_mode=None, query_text=None, with_vectors=False):
+    return query_vectors("files", provider, repo, vector, top_k, ef_search, probes, search_mode, query_text, with_vectors)
+
+
+def query_folders(provider, repo, vector, top_k=5, ef_search=None, probes=None, search_mode=None, query_text=None, with_vectors=False):
+    return query_vectors("folders", provider, repo, vector, top_k, ef_search, probes, search_mode, query_text, with_vectors)
+
+
+def query_commits(provider, repo, vector, top_k=5, ef_search=None, probes=None, search_mode=None, query_text=None, with_vectors=False):
+    return query_vectors("commits", provider, repo, vector, top_k, ef_search, probes, search_mode, query_text, with_vectors)
+
+
+def query_chunks(provider, repo, vector, top_k=5, ef_search=None, probes=None, search_mode=None, query_text=None, with_vectors=False):
+    return query_vectors("chunks", provider, repo, vector, top_k, ef_search, probes, search_mode, query_text, with_vectors)
+
+
+def query_context(provider, repo, vector, top_k, ef_search=None, probes=None, search_mode=None, query_text=None, with_vectors=False):
+    """
+    Fetches the nearest rows of several context types in one statement.
+
+    `top_k` maps each context type to the number of rows wanted. Returns a dict
+    mapping each type to rows shaped like query_folders/files/commits return,
+    followed by the row's vector if `with_vectors` is set. `query_text` is the
+    question, which "hybrid" mode also searches for.
+    """
+    search_mode = search_mode or SEARCH_MODES[provider]
+    tables = [table for table in CONTEXT_COLUMNS if table in top_k]
+    if not tables:
+        return {}
+    width = max(len(CONTEXT_COLUMNS[table]) for table in tables)
+
+    branches = []
+    params = search_params(repo, vector, search_mode, query_text)
+    for table in tables:
+        columns = context_columns(table, provider)
+        padding = ["NULL::text"] * (width - len(columns))
+        search = search_sql(CONTEXT_TABLES.get(table, table), ", ".join(context_columns(table, provider, with_vectors)),
+                            provider, search_mode, param_prefix=f"{table}_")
+        # The vector, if any, always comes last, after the padding
+        vectors = ["context_vector"] if with_vectors else []
+        # row_number() over the already ordered subquery keeps each type's rank
+        branches.append(f"""
+            SELECT '{table}' AS source, row_number() OVER () AS rank, {", ".join(columns + padding + vectors)}
+            FROM ({search}) {table}""")
+        params[f"{table}_top_k"] = top_k[table]
+        params[f"{table}_candidates"] = top_k[table] * RERANK_OVERFETCH
+    query = "\n            UNION ALL".join(branches)
+
+    with metrics.span("query", table="+".join(tables), provider=provider, mode=search_mode) as span, get_cursor() as cur:
+        set_search_params(cur, ef_search, probes)
+        execute_search(cur, f"fetch_{'_'.join(tables)}_{provider}_{search_mode}{'_vectors' if with_vectors else ''}",
+                       query, params)
+        rows = cur.fetchall()
+        span.add(rows=len(rows))
 
-    vector = generate_openai_embedding(
+    context = {table: [] for table in tables}
+    for source, rank, *values in sorted(rows, key=lambda row: (row[0], row[1])):
+        context[source].append(tuple(values[:len(CONTEXT_COLUMNS[source])] + values[len(values) - len(vectors):]))
+    return context
+
+
+def context_candidates(results):
+    """
+    Formats retrieved rows as (context_type, label, text, vector) candidates
+    for the prompt, folders first. Rows fetched without vectors get None.
+    """
+    candidates = []
+
+    for folder in results.get("folders", []):
+        name, description, *vector = folder
+        candidates.append(("folders", f"folder {name}", f"FOLDER: {name}\nDESCRIPTION: {description}",
+                           vector[0] if vector else None))
+
+    for file in results.get("files", []):
+        name, folder_name, description, *vector = file
+        candidates.append(("files", f"file {folder_name}/{name}",
+                           f"FILE: {name}\nFOLDER: {folder_name}\nDESCRIPTION:\n{description}",
+                           vector[0] if vector else None))
+
+    for chunk in results.get("chunks", []):
+        name, folder_name, start_line, end_line, code, description, *vector = chunk
+        candidates.append(("chunks", f"file {folder_name}/{name} lines {start_line}-{end_line}",
+                           f"FILE: {name}\nFOLDER: {folder_name}\nLINES: {start_line}-{end_line}\n"
+                           f"DESCRIPTION:\n{description}\nCODE:\n{code}",
+                           vector[0] if vector else None))
+
+    for commit in results.get("commits", []):
+        _, commit_id, description, *vector = commit
+        candidates.append(("commits", f"commit {commit_id}", f"COMMIT: {commit_id}\nDESCRIPTION: {description}\n\n",
+                           vector[0] if vector else None))
+
+    return candidates
+
+
+def question_embedding(provider: str, question: str):
+    return generate_openai_embedding(
         question) if provider == "openai" else generate_ubicloud_embedding(question)
 
-    context = []
 
-    if "folders" in context_types:
-        folders = query_folders(provider, repo, vector)
-        for folder in folders:
-            name, description = folder
-            context.append(f"FOLDER: {name}\nDESCRIPTION: {description}")
+async def question_embedding_async(provider: str, question: str):
+    """
+    question_embedding for asyncio. Ubicloud questions are embedded over its
+    async client; the OpenAI embedding runs in a thread.
+    """
+    if provider == "ubicloud":
+        return await generate_ubicloud_embedding_async(question)
+    return await asyncio.to_thread(generate_openai_embedding, question)
 
-    if "files" in context_types:
-        files = query_files(provider, repo, vector)
-        for file in files:
-            name, code, folder_name, description = file
-            context.append(
-                f"FILE: {name}\nFOLDER: {folder_name}\nDESCRIPTION:\n{description}")
 
-    if "commits" in context_types:
-        commits = query_commits(provider, repo, vector)
-        for commit in commits:
-            repo, commit_id, description = commit
-            context.append(
-                f"COMMIT: {commit_id}\nDESCRIPTION: {description}\n\n")
+def retrieval_settings(provider: str, context_types, ef_search=None, probes=None, search_mode=None, top_k=5):
+    """
+    The settings get_prompt retrieves context with, as cached answers are
+    keyed: the search mode and a limit per context type, resolved as
+    get_prompt does, and ef_search and probes.
+    """
+    if not isinstance(top_k, dict):
+        top_k = {context_type: top_k for context_type in context_types}
+    limits = ",".join(f"{context_type}:{top_k.get(context_type, 5)}"
+                      for context_type in sorted(context_types) if context_type in CONTEXT_COLUMNS)
+    return {"search_mode": search_mode or SEARCH_MODES[provider], "top_k": limits,
+            "ef_search": ef_search, "probes": probes}
+
+
+def cached_answer(provider: str, repo: str, question: str, context_types, settings=None):
+    """
+    Embeds `question` and looks up the answer to the same or a close enough
+    question, retrieved with the same `settings`, in the answer cache.
+    Returns the embedding, for get_prompt and answer_cache.store, the cached
+    (question, prompt, answer) or None, and the repo's indexed_at to store a
+    new answer under.
+    """
+    vector = question_embedding(provider, question)
+    hit, indexed_at = answer_cache.lookup(provider, repo, context_types, vector, settings)
+    return vector, hit, indexed_at
+
+
+@metrics.timed("get_prompt")
+def get_prompt(provider: str, repo: str, question: str, context_types, ef_search=None, probes=None, search_mode=None, top_k=5, single_query=True, pack=True, token_budget=None, vector=None) -> str:
+    """
+    Builds the prompt for `question` with context of `context_types`
+    (folders, files, commits, or chunks: the best sections of files, with
+    their code) retrieved by `search_mode`: "exact" or "binary" vector
+    search, or "hybrid" to also match the words of the question in file
+    names, code, summaries and commit messages. The default mode is per
+    provider (SEARCH_MODES).
+
+    With `pack`, PACK_OVERFETCH times `top_k` candidates are fetched per type
+    and pack_context picks up to `top_k` of each, relevant and not redundant,
+    within `token_budget` (by default the provider's CONTEXT_TOKEN_BUDGETS).
+    Otherwise the `top_k` nearest rows per type are all included.
+    `vector` is the question's embedding, if already computed.
+    """
+    if provider not in ["openai", "ubicloud"]:
+        raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
+
+    # top_k is either one limit for every context type or a limit per type
+    if not isinstance(top_k, dict):
+        top_k = {context_type: top_k for context_type in context_types}
+    top_k = {context_type: top_k.get(context_type, 5)
+             for context_type in context_types if context_type in CONTEXT_COLUMNS}
+    if not top_k:
+        return f"Answer the question about the {repo} repo: {question}"
+    limits = top_k
+    if pack:
+        top_k = {context_type: limit * PACK_OVERFETCH for context_type, limit in top_k.items()}
+
+    if vector is None:
+        vector = question_embedding(provider, question)
+
+    if single_query:
+        results = query_context(provider, repo, vector, top_k,
+                                ef_search=ef_search, probes=probes, search_mode=search_mode, query_text=question, with_vectors=pack)
+    else:
+        queries = {"folders": query_folders, "files": query_files,
+                   "commits": query_commits, "chunks": query_chunks}
+        results = {context_type: queries[context_type](provider, repo, vector, limit,
+                                                       ef_search=ef_search, probes=probes, search_mode=search_mode, query_text=question, with_vectors=pack)
+                   for context_type, limit in top_k.items()}
+
+    candidates = context_candidates(results)
+    if pack:
+        with metrics.span("pack_context", provider=provider):
+            context, _ = pack_context(vector, candidates,
+                                      token_budget or CONTEXT_TOKEN_BUDGETS[provider], limits)
+    else:
+        context = [text for _, _, text, _ in candidates]
 
     context_count = len(context)
     if context_count == 0:
@@ -118,18 +408,48 @@ def get_prompt(provider: str, repo: str, question: str, context_types) -> str:
     return prompt
 
 
-def ask_question(provider: str, repo: str, question: str, context_types, return_prompt=False) -> str:
+@metrics.timed("ask_question")
+def ask_question(provider: str, repo: str, question: str, context_types, return_prompt=False, ef_search=None, probes=None, search_mode=None, top_k=5, use_cache=True) -> str:
+    """
+    Answers `question` with context retrieved as by get_prompt. With
+    `use_cache`, a cached answer to the same or a close enough question,
+    retrieved with the same settings, is returned instead, and a new answer
+    is cached. Answers without context are not cached.
+    """
     if provider not in ["openai", "ubicloud"]:
         raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
 
-    prompt = get_prompt(provider, repo, question, context_types)
+    settings = retrieval_settings(provider, context_types, ef_search=ef_search, probes=probes,
+                                  search_mode=search_mode, top_k=top_k)
+    if use_cache and context_types:
+        vector, hit, indexed_at = cached_answer(provider, repo, question, context_types, settings)
+        if hit:
+            _, prompt, answer = hit
+            return (answer, prompt) if return_prompt else answer
+    else:
+        vector, indexed_at = None, None
+    prompt = get_prompt(provider, repo, question, context_types,
+                        ef_search=ef_search, probes=probes, search_mode=search_mode, top_k=top_k, vector=vector)
     ask = ask_openai if provider == "openai" else ask_ubicloud
     answer = ask(prompt)
+    answer_cache.store(provider, repo, context_types, indexed_at, question, vector, prompt, answer, settings)
     if return_prompt:
         return answer, prompt
     return answer
 
 
+async def stream_answer_async(provider: str, prompt: str):
+    """
+    Yields the answer to a prompt built by get_prompt as it grows, over the
+    providers' async clients.
+    """
+    ask = ask_openai_stream_async if provider == "openai" else ask_ubicloud_stream_async
+    answer = ""
+    async for delta in ask(prompt):
+        answer += delta
+        yield answer
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 4:
         print("Usage: python ask_question.py <provider> <repo> <question>")
@@ -1,39 +1,69 @@
 import os
-import sys
-import json
+import time
+import argparse
 import psycopg2
-from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from db_pool import CountingCursor
+from pgconf_utils import generate_openai_embeddings, generate_ubicloud_embeddings
+from vector_writer import update_vectors, to_vector
 from dotenv import load_dotenv
 load_dotenv()
 
 # DB connection
 DATABASE_URL = os.getenv("DATABASE_URL")
-conn = psycopg2.connect(DATABASE_URL)
+conn = psycopg2.connect(DATABASE_URL, cursor_factory=CountingCursor)
 cur = conn.cursor()
 
 # SQL queries to fetch repos, folders, and files missing embeddings
 FETCH_FOLDERS = """SELECT "name", "llm_openai", "llm_ubicloud" FROM folders WHERE "vector_openai" IS NULL AND "repo" = %s;"""
 FETCH_FILES = """SELECT "name", "folder", "llm_openai", "llm_ubicloud" FROM files WHERE "vector_openai" IS NULL AND "repo" = %s;"""
 FETCH_COMMITS = """SELECT "repo", "id", "llm_openai", "llm_ubicloud" FROM commits WHERE "vector_openai" IS NULL AND "repo" = %s;"""
+FETCH_CHUNKS = """SELECT "folder", "name", "chunk", "llm_openai", "llm_ubicloud" FROM file_chunks WHERE "vector_openai" IS NULL AND "repo" = %s;"""
 
-# SQL query to update embedding
-UPDATE_EMBEDDING_FOLDER = """UPDATE folders SET vector_openai = %s, vector_ubicloud = %s WHERE "name" = %s AND repo = %s"""
-UPDATE_EMBEDDING_FILE = """UPDATE files SET vector_openai = %s, vector_ubicloud = %s WHERE "name" = %s AND folder = %s AND repo = %s;"""
-UPDATE_EMBEDDING_COMMIT = """UPDATE commits SET vector_openai = %s, vector_ubicloud = %s WHERE "repo" = %s AND "id" = %s;"""
+# Columns identifying the row to update, in the order the keys below carry them
+KEY_COLUMNS_FOLDER = ["name", "repo"]
+KEY_COLUMNS_FILE = ["name", "folder", "repo"]
+KEY_COLUMNS_COMMIT = ["repo", "id"]
+KEY_COLUMNS_CHUNK = ["repo", "folder", "name", "chunk"]
+
+
+# Rows embedded per provider request round and committed together
+BACKFILL_BATCH_SIZE = 100
+
+
+def write_vectors(table, key_columns, batch, vectors_openai, vectors_ubicloud):
+    update_vectors(cur, table, key_columns, [
+        (*key, to_vector(vector_openai), to_vector(vector_ubicloud))
+        for (key, _, _), vector_openai, vector_ubicloud in zip(batch, vectors_openai, vectors_ubicloud)])
+
+
+def embed_and_update(rows, table, key_columns):
+    """
+    `rows` are (key, llm_openai, llm_ubicloud) tuples, where key holds the
+    values of `key_columns` for the row.
+    """
+    rows = [row for row in rows if row[1]]
+    for i in range(0, len(rows), BACKFILL_BATCH_SIZE):
+        batch = rows[i:i + BACKFILL_BATCH_SIZE]
+        with metrics.span("backfill_batch", table=table) as span:
+            span.add(rows=len(batch))
+            vectors_ubicloud = generate_ubicloud_embeddings(
+                [llm_ubicloud for _, _, llm_ubicloud in batch])
+            vectors_openai = generate_openai_embeddings(
+                [llm_openai for _, llm_openai, _ in batch])
+            write_vectors(table, key_columns, batch,
+                          vectors_openai, vectors_ubicloud)
+            conn.commit()
+        print(f"Embedded {min(i + BACKFILL_BATCH_SIZE, len(rows))}/{len(rows)}...")
 
 
 def backfill_folders(repo: str):
     cur.execute(FETCH_FOLDERS, (repo, ))
     folders = cur.fetchall()
     print(f"Backfilling {len(folders)} folders...")
-    for folder in folders:
-        name, llm_openai, llm_ubicloud = folder
-        if llm_openai:
-            vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-            vector_openai = generate_openai_embedding(llm_openai)
-            cur.execute(UPDATE_EMBEDDING_FOLDER,
-                        (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, repo))
-            conn.commit()
+    embed_and_update([((name, repo), llm_openai, llm_ubicloud)
+                      for name, llm_openai, llm_ubicloud in folders], "folders", KEY_COLUMNS_FOLDER)
     print("Backfilling for folders complete.")
 
 
@@ -41,14 +71,8 @@ def backfill_files(repo: str):
     cur.execute(FETCH_FILES, (repo, ))
     files = cur.fetchall()
     print(f"Backfilling {len(files)} files...")
-    for file in files:
-        name, folder, llm_openai, llm_ubicloud = file
-        if llm_openai:
-            vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-            vector_openai = generate_openai_embedding(llm_openai)
-            cur.execute(UPDATE_EMBEDDING_FILE,
-                        (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, folder, repo))
-            conn.commit()
+    embed_and_update([((name, folder, repo), llm_openai, llm_ubicloud)
+                      for name, folder, llm_openai, llm_ubicloud in files], "files", KEY_COLUMNS_FILE)
     print("Backfilling for files complete.")
 
 
@@ -56,30 +80,166 @@ def backfill_commits(repo: str):
     cur.execute(FETCH_COMMITS, (repo, ))
     commits = cur.fetchall()
     print(f"Backfilling {len(commits)} commits...")
-    for commit in commits:
-        repo, commit_id, llm_openai, llm_ubicloud = commit
-        if llm_openai:
-            vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-            vector_openai = generate_openai_embedding(llm_openai)
-            cur.execute(UPDATE_EMBEDDING_COMMIT,
-                        (json.dumps(vector_openai), json.dumps(vector_ubicloud), repo, commit_id))
-            conn.commit()
+    embed_and_update([((repo, commit_id), llm_openai, llm_ubicloud)
+                      for repo, commit_id, llm_openai, llm_ubicloud in commits], "commits", KEY_COLUMNS_COMMIT)
     print("Backfilling for commits complete.")
 
 
+def backfill_chunks(repo: str):
+    cur.execute(FETCH_CHUNKS, (repo, ))
+    chunks = cur.fetchall()
+    print(f"Backfilling {len(chunks)} file chunks...")
+    embed_and_update([((repo, folder, name, chunk), llm_openai, llm_ubicloud)
+                      for folder, name, chunk, llm_openai, llm_ubicloud in chunks], "file_chunks", KEY_COLUMNS_CHUNK)
+    print("Backfilling for file chunks complete.")
+
+
+# Per table: the fetch query, the key columns, and how a fetched row maps to
+# the (key, llm_openai, llm_ubicloud) tuples that embed_and_update also uses
+BACKFILL_TABLES = {
+    "folders": (FETCH_FOLDERS, KEY_COLUMNS_FOLDER,
+                lambda row, repo: ((row[0], repo), row[1], row[2])),
+    "files": (FETCH_FILES, KEY_COLUMNS_FILE,
+              lambda row, repo: ((row[0], row[1], repo), row[2], row[3])),
+    "commits": (FETCH_COMMITS, KEY_COLUMNS_COMMIT,
+                lambda row, repo: ((row[0], row[1]), row[2], row[3])),
+    "file_chunks": (FETCH_CHUNKS, KEY_COLUMNS_CHUNK,
+                    lambda row, repo: ((repo, row[0], row[1], row[2]), row[3], row[4])),
+}
+BACKFILL_WORKERS = 4
+BACKFILL_COMMIT_EVERY = 500
+BACKFILL_PROGRESS_EVERY = 10
+
+
+def stream_batches(read_conn, fetch_query, repo, batch_size):
+    # A named cursor streams rows from the server instead of loading them all;
+    # WITH HOLD keeps it open across the commits made on the write connection.
+    with read_conn.cursor(name="backfill_stream", withhold=True) as stream:
+        stream.itersize = batch_size
+        stream.execute(fetch_query, (repo,))
+        while True:
+            with metrics.span("db_fetch", bind=False) as span:
+                rows = stream.fetchmany(batch_size)
+                span.add(rows=len(rows))
+            if not rows:
+                return
+            yield rows
+
+
+def backfill_table_pipelined(table, repo, executor, read_conn, workers, batch_size, commit_every):
+    """
+    Streams the rows of `table` that are missing vectors and embeds them in
+    batches, with both providers' requests for up to `workers` batches in
+    flight at once. Finished batches are written as they complete and
+    committed every `commit_every` rows. Because only rows still missing
+    vectors are fetched, an interrupted run resumes where it left off.
+    """
+    fetch_query, key_columns, to_row = BACKFILL_TABLES[table]
+    in_flight = {}
+    done = uncommitted = 0
+    started = last_report = time.monotonic()
+
+    def write_completed(completed):
+        nonlocal done, uncommitted
+        for future in completed:
+            batch = in_flight.pop(future)
+            vectors_openai, vectors_ubicloud = future.result()
+            write_vectors(table, key_columns, batch,
+                          vectors_openai, vectors_ubicloud)
+            done += len(batch)
+            uncommitted += len(batch)
+        if uncommitted >= commit_every:
+            conn.commit()
+            uncommitted = 0
+
+    def embed(batch):
+        # Both providers are requested at the same time for each batch
+        with metrics.span("backfill_batch", table=table) as span:
+            span.add(rows=len(batch))
+            ubicloud = executor.submit(generate_ubicloud_embeddings,
+                                       [llm_ubicloud for _, _, llm_ubicloud in batch])
+            openai = executor.submit(generate_openai_embeddings,
+                                     [llm_openai for _, llm_openai, _ in batch])
+            return openai.result(), ubicloud.result()
+
+    print(f"Backfilling {table}...")
+    batch_executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for rows in stream_batches(read_conn, fetch_query, repo, batch_size):
+            batch = [row for row in (to_row(row, repo) for row in rows) if row[1]]
+            if batch:
+                in_flight[batch_executor.submit(embed, batch)] = batch
+            while len(in_flight) >= workers:
+                completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                write_completed(completed)
+
+            now = time.monotonic()
+            if now - last_report >= BACKFILL_PROGRESS_EVERY:
+                last_report = now
+                print(f"{table}: {done} rows, {done / (now - started):.1f} rows/s, "
+                      f"{2 * len(in_flight)} requests in flight")
+
+        write_completed(wait(in_flight).done)
+        conn.commit()
+    except BaseException:
+        # On an error or interrupt, what was committed is kept; rows written
+        # since the last commit are rolled back and retried by the next run.
+        conn.rollback()
+        raise
+    finally:
+        for future in in_flight:
+            future.cancel()
+        batch_executor.shutdown(wait=False, cancel_futures=True)
+        read_conn.rollback()
+
+    elapsed = time.monotonic() - started
+    print(f"Backfilling for {table} complete: {done} rows in {elapsed:.1f}s "
+          f"({done / elapsed if elapsed else 0:.1f} rows/s).")
+
+
+@metrics.timed("backfill")
+def backfill_pipelined(repo, workers=BACKFILL_WORKERS, batch_size=BACKFILL_BATCH_SIZE, commit_every=BACKFILL_COMMIT_EVERY):
+    read_conn = psycopg2.connect(DATABASE_URL, cursor_factory=CountingCursor)
+    executor = ThreadPoolExecutor(max_workers=2 * workers)
+    try:
+        for table in BACKFILL_TABLES:
+            backfill_table_pipelined(table, repo, executor, read_conn,
+                                     workers, batch_size, commit_every)
+        print("Backfilling complete.")
+    except KeyboardInterrupt:
+        print("Backfilling interrupted. Re-run to resume from the remaining rows.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        read_conn.close()
+
+
+@metrics.timed("backfill")
 def backfill(repo):
     backfill_folders(repo)
     backfill_files(repo)
     backfill_commits(repo)
+    backfill_chunks(repo)
     print("Backfilling complete.")
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python backfill_embeddings.py <repo_name>")
-        sys.exit(1)
-    repo = sys.argv[1]
-    backfill(repo)
+    parser = argparse.ArgumentParser(
+        description="Embed summaries that are missing vectors.")
+    parser.add_argument("repo")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Stream rows and embed several batches concurrently.")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS,
+                        help="Batches in flight at once in pipelined mode.")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--commit-every", type=int,
+                        default=BACKFILL_COMMIT_EVERY)
+    args = parser.parse_args()
+    if args.pipelined:
+        backfill_pipelined(args.repo, args.workers,
+                           args.batch_size, args.commit_every)
+    else:
+        backfill(args.repo)
+    print(metrics.summary())
 
     cur.close()
     conn.close()
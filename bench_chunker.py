@@ -0,0 +1,84 @@
+import os
+import time
+import argparse
+from chunker import chunk_file, chunk_text, count_tokens, PROMPT_RESERVE_TOKENS
+
+# Only the context windows are read from pgconf_utils; the offline backend
+# lets it load without API keys
+os.environ.setdefault("LLM_BACKEND", "fake")
+from pgconf_utils import OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW
+
+
+def synthetic_c_file(functions):
+    """
+    A C file of `functions` functions with nested blocks, like the large
+    generated sources that dominate chunking time.
+    """
+    parts = []
+    for i in range(functions):
+        parts.append(f"""static int function_{i}(struct state *s, const char *input, size_t length)
+{{
+  int result = 0;
+  for (size_t j = 0; j < length; j++) {{
+    if (input[j] == '{chr(97 + i % 26)}') {{
+      result += s->weights[j % STATE_WEIGHTS] * {i};
+    }} else {{
+      result -= process_{i % 7}(s, input + j, length - j);
+    }}
+  }}
+  return result;
+}}
+""")
+    return "\n".join(parts)
+
+
+def timed(fn, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def describe(name, seconds, chunk_sets, windows):
+    print(f"{name}: {seconds * 1000:.1f} ms")
+    for chunks, window in zip(chunk_sets, windows):
+        sizes = [count_tokens(chunk) for chunk in chunks]
+        over = sum(size > window for size in sizes)
+        print(f"  window {window}: {len(chunks)} chunks, largest {max(sizes)} tokens, {over} over the window")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the character-based and the token-aware chunkers.")
+    parser.add_argument("files", nargs="*",
+                        help="C files to chunk; a synthetic one is generated if none are given.")
+    parser.add_argument("--functions", type=int, default=20000,
+                        help="Functions in the synthetic file.")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.files:
+        sources = []
+        for path in args.files:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                sources.append((path, f.read()))
+    else:
+        sources = [("synthetic.c", synthetic_c_file(args.functions))]
+
+    windows = [OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW]
+    budgets = [window - PROMPT_RESERVE_TOKENS for window in windows]
+    for name, text in sources:
+        print(f"{name}: {len(text)} chars, {count_tokens(text)} tokens")
+        seconds, chunk_sets = timed(
+            lambda: [chunk_file(text, window) for window in windows], args.rounds)
+        describe("chunk_file, once per window", seconds, chunk_sets, windows)
+        seconds, chunk_sets = timed(
+            lambda: chunk_text(text, budgets, name), args.rounds)
+        describe("chunk_text, both budgets in one pass", seconds, chunk_sets, windows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+import time
+import argparse
+
+LANGUAGES = {
+    "c": ("int function_{i}(int x)\n{{\n  return x * {i} + helper_{j}(x);\n}}\n", 40),
+    "py": ("def function_{i}(x):\n    \"\"\"Scales x by {i}.\"\"\"\n    return x * {i} + helper_{j}(x)\n", 40),
+    "md": ("## Section {i}\n\nNotes about step {i}, which follows step {j}.\n", 20),
+}
+
+
+def generate_fixture(repo_path, files):
+    """
+    Writes `files` small source files into folders of ten, so a run exercises
+    both file and folder summaries.
+    """
+    kinds = sorted(LANGUAGES)
+    for n in range(files):
+        folder = os.path.join(repo_path, f"module_{n // 10}")
+        os.makedirs(folder, exist_ok=True)
+        suffix = kinds[n % len(kinds)]
+        template, repeats = LANGUAGES[suffix]
+        with open(os.path.join(folder, f"file_{n}.{suffix}"), "w") as f:
+            f.write("\n".join(template.format(i=n * repeats + i, j=i) for i in range(repeats)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingest a repository under repos/ end to end against a stand-in provider "
+                    "and report the throughput.")
+    parser.add_argument("repo")
+    parser.add_argument("--generate", type=int, metavar="FILES",
+                        help="First write a synthetic repository of this many files to repos/<repo>.")
+    parser.add_argument("--backend", choices=["fake", "http"], default="fake",
+                        help="Answer in-process, or through a local server speaking both HTTP APIs.")
+    parser.add_argument("--llm-latency", type=float, default=0.05,
+                        help="Seconds each fake completion takes.")
+    parser.add_argument("--embedding-latency", type=float, default=0.02,
+                        help="Seconds each fake embedding request takes.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of fake calls that fail.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--commits", action="store_true",
+                        help="Also summarize the commit history.")
+    parser.add_argument("--reset", action="store_true",
+                        help="Drop the repository's partitions first, so it is ingested again.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the completion and embedding caches.")
+    args = parser.parse_args()
+
+    # The provider settings are read when the modules are imported
+    os.environ["FAKE_LLM_LATENCY"] = str(args.llm_latency)
+    os.environ["FAKE_EMBEDDING_LATENCY"] = str(args.embedding_latency)
+    os.environ["FAKE_ERROR_RATE"] = str(args.error_rate)
+    if args.no_cache:
+        os.environ["COMPLETION_CACHE"] = "0"
+        os.environ["EMBEDDING_CACHE"] = "0"
+    if args.backend == "fake":
+        os.environ["LLM_BACKEND"] = "fake"
+    else:
+        import fake_provider
+        server = fake_provider.serve()
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+        # The live code paths, pointed at the fake server
+        os.environ["LLM_BACKEND"] = "live"
+        os.environ["OPENAI_API_KEY"] = "fake"
+        os.environ["UBICLOUD_API_KEY"] = "fake"
+        os.environ["OPENAI_BASE_URL"] = base_url
+        os.environ["UBICLOUD_LLM_API_URL"] = f"{base_url}/chat/completions"
+        os.environ["UBICLOUD_VECTOR_API_URL"] = f"{base_url}/embeddings"
+
+    import fake_provider
+    import process_repo
+    from db_pool import db_roundtrips
+
+    if args.generate:
+        generate_fixture(f"repos/{args.repo}", args.generate)
+    if args.reset:
+        process_repo.drop_repo(args.repo)
+
+    roundtrips = db_roundtrips()
+    started = time.monotonic()
+    failure = None
+    try:
+        process_repo.main(args.repo, args.workers or process_repo.INGEST_WORKERS, args.commits)
+    except Exception as e:
+        # A call still failing after RATE_LIMIT_RETRIES attempts ends the run
+        failure = e
+    elapsed = time.monotonic() - started
+    roundtrips = db_roundtrips() - roundtrips
+
+    stats = fake_provider.fake_stats()
+    files = sum(len(names) for names, _ in process_repo.walk_tree(f"repos/{args.repo}").values())
+    print()
+    print(f"Backend: {args.backend}, LLM latency {args.llm_latency}s, "
+          f"embedding latency {args.embedding_latency}s, error rate {args.error_rate}")
+    if failure:
+        print(f"Run failed: {failure}")
+    print(f"Wall time: {elapsed:.2f}s")
+    print(f"Files: {files} ({files / elapsed:.1f} files/s)")
+    print(f"LLM calls: {stats['completions']}")
+    print(f"Embedding requests: {stats['embedding_requests']} ({stats['embedded_texts']} texts)")
+    print(f"Injected errors: {stats['errors']}")
+    print(f"DB roundtrips: {roundtrips}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import os
+import argparse
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+TABLES = ["folders", "files", "commits", "file_chunks"]
+VECTOR_DIMENSIONS = {"openai": 1536, "ubicloud": 4096}
+# pgvector cannot build HNSW or IVFFlat indexes on `vector` columns wider than
+# this; wider columns get an index on their binary quantization instead
+MAX_INDEX_DIMENSIONS = 2000
+
+
+def index_name(partition, provider, binary=False):
+    name = f"{partition}_vector_{provider}"
+    if binary:
+        name += "_bq"
+    return name + "_idx"
+
+
+def partitions(cur, table, repo=None):
+    """
+    The per-repo partitions of `table`, or only `repo`'s, which there are none
+    of until the repo is ingested.
+    """
+    if repo is not None:
+        cur.execute("SELECT to_regclass(repo_partition(%s, %s))::text", (table, repo))
+    else:
+        cur.execute("""
+            SELECT relid::regclass::text FROM pg_partition_tree(%s)
+            WHERE isleaf ORDER BY 1""", (table,))
+    return [partition for partition, in cur.fetchall() if partition is not None]
+
+
+def build_index(cur, partition, provider, method, m, ef_construction, lists):
+    dimensions = VECTOR_DIMENSIONS[provider]
+    # Vectors too wide to index are indexed through their binary quantization
+    binary = dimensions > MAX_INDEX_DIMENSIONS
+    name = index_name(partition, provider, binary)
+    if binary:
+        expression = f"""(binary_quantize("vector_{provider}")::bit({dimensions})) bit_hamming_ops"""
+    else:
+        expression = f""""vector_{provider}" vector_l2_ops"""
+    if method == "hnsw":
+        options = f"WITH (m = {m}, ef_construction = {ef_construction})"
+    else:
+        options = f"WITH (lists = {lists})"
+
+    # Indexes are per partition: a partitioned table cannot be indexed
+    # concurrently, and each repo's graph only holds that repo's rows. The new
+    # index is built next to the old one, which keeps serving searches until
+    # it is swapped in.
+    print(f"Building {method} index {name}...")
+    new_name = name + "_new"
+    # Left invalid by an interrupted build
+    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name}")
+    cur.execute(
+        f"""CREATE INDEX CONCURRENTLY {new_name} ON {partition} USING {method} ({expression}) {options}""")
+    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"ALTER INDEX {new_name} RENAME TO {name}")
+    print(f"Index {name} built.")
+
+
+def storage_report(cur, tables):
+    """
+    Prints heap, TOAST and index sizes per table, and the average stored size of
+    each vector column next to its halfvec and binary-quantized equivalents.
+    """
+    cur.execute("SHOW shared_buffers")
+    print(f"shared_buffers: {cur.fetchone()[0]}")
+    total_index_bytes = 0
+    for table in tables:
+        # The parent holds no data; its sizes are the sums over its partitions
+        cur.execute("""
+            SELECT pg_size_pretty(sum(pg_table_size(p.relid))),
+                   pg_size_pretty(sum(coalesce(pg_total_relation_size(nullif(c.reltoastrelid, 0)), 0))),
+                   pg_size_pretty(sum(pg_indexes_size(p.relid))),
+                   coalesce(sum(pg_indexes_size(p.relid)), 0)
+            FROM pg_partition_tree(%s) p JOIN pg_class c ON c.oid = p.relid
+            WHERE p.isleaf""", (table,))
+        table_size, toast_size, indexes_size, indexes_bytes = cur.fetchone()
+        total_index_bytes += indexes_bytes
+        print(f"{table}: table {table_size} (TOAST {toast_size}), indexes {indexes_size}")
+
+        cur.execute("""
+            SELECT indexrelid::regclass, pg_size_pretty(pg_relation_size(indexrelid))
+            FROM pg_index JOIN pg_partition_tree(%s) p ON indrelid = p.relid
+            WHERE p.isleaf ORDER BY 1""", (table,))
+        for index, size in cur.fetchall():
+            print(f"  {index}: {size}")
+
+        for provider, dimensions in VECTOR_DIMENSIONS.items():
+            # Sample rather than scan: the averages only need to be indicative
+            cur.execute(f"""
+                SELECT count(*),
+                       avg(pg_column_size(v)),
+                       avg(pg_column_size(v::halfvec({dimensions}))),
+                       avg(pg_column_size(binary_quantize(v)::bit({dimensions})))
+                FROM (SELECT "vector_{provider}" AS v FROM {table}
+                      WHERE "vector_{provider}" IS NOT NULL LIMIT 1000) sample""")
+            count, vector_bytes, halfvec_bytes, bit_bytes = cur.fetchone()
+            if count:
+                print(f"  vector_{provider}: {vector_bytes:.0f} B/row, halfvec {halfvec_bytes:.0f} B/row, binary {bit_bytes:.0f} B/row")
+    cur.execute("SELECT pg_size_pretty(%s::bigint)", (total_index_bytes,))
+    print(f"Total index size: {cur.fetchone()[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="(Re)build vector indexes without blocking writes.")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--lists", type=int, default=100)
+    parser.add_argument("--maintenance-work-mem", default="1GB")
+    parser.add_argument("--parallel-workers", type=int, default=None)
+    parser.add_argument("--repo", default=None,
+                        help="Only build the indexes of this repo's partitions.")
+    parser.add_argument("--tables", nargs="+", choices=TABLES, default=TABLES)
+    parser.add_argument("--providers", nargs="+",
+                        choices=list(VECTOR_DIMENSIONS), default=list(VECTOR_DIMENSIONS))
+    parser.add_argument("--report", action="store_true",
+                        help="Print table, TOAST and index sizes before and after the build.")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(DATABASE_URL)
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+    if args.repo is not None and not any(partitions(cur, table, args.repo) for table in args.tables):
+        print(f"Repository '{args.repo}' has no partitions; ingest it with process_repo.py first. Exiting...")
+        cur.close()
+        conn.close()
+        return
+    cur.execute("SET maintenance_work_mem = %s", (args.maintenance_work_mem,))
+    if args.parallel_workers is not None:
+        cur.execute("SET max_parallel_maintenance_workers = %s",
+                    (args.parallel_workers,))
+
+    if args.report:
+        print("Before:")
+        storage_report(cur, args.tables)
+
+    for provider in args.providers:
+        for table in args.tables:
+            for partition in partitions(cur, table, args.repo):
+                build_index(cur, partition, provider, args.method, args.m,
+                            args.ef_construction, args.lists)
+
+    if args.report:
+        print("After:")
+        storage_report(cur, args.tables)
+
+    cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import os
+import re
+from bisect import bisect_right
+from itertools import accumulate
+from dotenv import load_dotenv
+
+load_dotenv()
+# "tiktoken" to count tokens exactly (for OpenAI models), "chars" to estimate
+# them from the length, or "auto" to use tiktoken when it is installed and its
+# encoding can be loaded (it is downloaded on first use)
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "auto")
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "o200k_base")
+CHARS_PER_TOKEN = 4
+# Tokens of each context window left for the prompt and the answer when a
+# file is split into chunks
+PROMPT_RESERVE_TOKENS = 4000
+# A chunk is only cut at a boundary once it is at least this full; below that
+# it grows until it is cut at the budget instead
+MIN_CHUNK_FILL = 0.5
+
+# Boundary strengths: the strongest boundary that leaves a full enough chunk
+# behind is where a chunk ends
+WEAK, STRONG = 1, 2
+
+C_LIKE = {'.c', '.h', '.cpp', '.hpp', '.java', '.js', '.jsx', '.ts', '.tsx',
+          '.go', '.rs', '.cs', '.swift', '.kt', '.php'}
+# Per language, a pattern for the lines a chunk may end right after and one for
+# the lines it may start with. The strength of a match is given by which of
+# the pattern's groups matched.
+BOUNDARIES = {
+    "c": {
+        "after": (re.compile(r'^(?:(\}|\};|\];)|(\s{2,4}\}))\s*$'), (STRONG, WEAK)),
+    },
+    "python": {
+        "before": (re.compile(r'^(?:(class\s|def\s|async\s+def\s|@)|(\s+(?:def\s|async\s+def\s|@)))'), (STRONG, WEAK)),
+    },
+    "sql": {
+        "after": (re.compile(r'^.*(;)\s*(?:--.*)?$'), (STRONG,)),
+        "before": (re.compile(r'^(\s*)$'), (WEAK,)),
+    },
+    "markdown": {
+        "before": (re.compile(r'^(?:(#{1,2}\s)|(#{3,6}\s))'), (STRONG, WEAK)),
+    },
+    "text": {
+        "before": (re.compile(r'^(\s*)$'), (WEAK,)),
+    },
+}
+PYTHON_DECORATOR = re.compile(r'^\s*@')
+
+
+def approximate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def get_tokenizer(name=CHUNK_TOKENIZER):
+    """
+    Returns a function that counts the tokens in a string.
+    """
+    if name in ("auto", "tiktoken"):
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            if name == "tiktoken":
+                raise
+            print(f"Counting tokens from the length, as tiktoken is unavailable: {e}")
+        else:
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+    return approximate_tokens
+
+
+_tokenizer = None
+
+
+def count_tokens(text):
+    """
+    Counts the tokens in `text` with the CHUNK_TOKENIZER, which is only loaded
+    on first use so importing this module never needs the network.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = get_tokenizer()
+    return _tokenizer(text)
+
+
+def file_language(file_name):
+    suffix = os.path.splitext(file_name)[1].lower()
+    if suffix in C_LIKE:
+        return "c"
+    if suffix == '.py':
+        return "python"
+    if suffix == '.sql':
+        return "sql"
+    if suffix == '.md':
+        return "markdown"
+    return "text"
+
+
+def truncate_line(line, budget, count):
+    """
+    Shortens a line that alone exceeds `budget` tokens.
+    """
+    line = line[:budget * CHARS_PER_TOKEN]
+    tokens = count(line)
+    while tokens > budget:
+        line = line[:int(len(line) * budget / tokens)]
+        tokens = count(line)
+    return line
+
+
+def boundaries(lines, language):
+    """
+    Returns the sorted line positions a chunk may end before, one list per
+    strength.
+    """
+    cuts = {STRONG: [], WEAK: []}
+    for side, (pattern, group_strengths) in BOUNDARIES[language].items():
+        offset = 1 if side == "after" else 0
+        for i, match in enumerate(map(pattern.match, lines)):
+            if match:
+                cuts[group_strengths[match.lastindex - 1]].append(i + offset)
+    if language == "python":
+        # Keep decorators with what they decorate
+        cuts = {strength: [i for i in positions if not (i and PYTHON_DECORATOR.match(lines[i - 1]))]
+                for strength, positions in cuts.items()}
+    if len(BOUNDARIES[language]) > 1:
+        cuts = {strength: sorted(set(positions)) for strength, positions in cuts.items()}
+    return cuts
+
+
+def split_lines(lines, weight, cuts, budget, count):
+    """
+    Greedily fills chunks of at most `budget` tokens from `lines`, where
+    weight(i) is the tokens in lines[:i].
+    """
+    chunks = []
+    start = 0
+    positions = range(len(lines) + 1)
+    while start < len(lines):
+        # Furthest end that fits, then the last boundary before it that
+        # leaves the chunk full enough
+        end = bisect_right(positions, weight(start) + budget, start, key=weight) - 1
+        if end == start:
+            chunks.append(truncate_line(lines[start], budget - 1, count))
+            start += 1
+            continue
+        if end < len(lines):
+            for strength in (STRONG, WEAK):
+                i = bisect_right(cuts[strength], end) - 1
+                cut = cuts[strength][i] if i >= 0 else 0
+                if cut > start and weight(cut) - weight(start) >= budget * MIN_CHUNK_FILL:
+                    end = cut
+                    break
+        chunks.append("\n".join(lines[start:end]))
+        start = end
+    return chunks
+
+
+def chunk_text(text, budgets, file_name="", count=None):
+    """
+    Splits `text` into chunks of at most each of `budgets` tokens, and returns
+    one list of chunks per budget. Lines are counted and classified once for
+    all budgets. Chunks end at the strongest boundary for the file's language
+    (a closing brace, a def, a statement, a header) that leaves them at least
+    half full.
+    """
+    count = count or count_tokens
+    lines = text.splitlines()
+    if count is approximate_tokens:
+        # Estimate whole chunks from their length rather than line by line
+        chars = list(accumulate(map(len, lines), initial=0))
+        def weight(i): return chars[i] / CHARS_PER_TOKEN + i
+    else:
+        tokens = list(accumulate(map(count, lines), initial=0))
+        def weight(i): return tokens[i] + i
+    # (The `+ i` counts the newline after each line as a token)
+    cuts = boundaries(lines, file_language(file_name))
+    return [split_lines(lines, weight, cuts, budget, count) for budget in budgets]
+
+
+def chunk_file(file_content, context_window):
+    """
+    Splits the file content into chunks, ensuring that each chunk ends at a function boundary.
+    Specifically, it looks for `}` at the beginning of a line as a natural break point.
+
+    The character-based chunker process_repo.py used before chunk_text; kept
+    as the baseline for bench_chunker.py.
+    """
+    chunks = []
+    current_chunk = []
+    current_size = 0
+
+    # Split the content into lines for easier processing
+    lines = file_content.splitlines()
+
+    for line in lines:
+        if len(line) > context_window:
+            line = line[:(context_window)]
+        current_chunk.append(line)
+        current_size += len(line)
+
+        # If we've reached a size limit
+        if (
+            (current_size >= context_window and (
+                re.match(r'^\}', line) or re.match(r'^\};', line) or re.match(r'^\];$', line)))
+            or (current_size >= 2 * context_window and (re.match(r'^\s{2}\}', line)))
+            or (current_size >= 3 * context_window)
+        ):
+            chunks.append("\n".join(current_chunk))
+            current_chunk = []
+            current_size = 0
+
+    # Add the remaining chunk if any content is left
+    if current_chunk:
+        chunks.append("\n".join(current_chunk))
+
+    return chunks
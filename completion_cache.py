@@ -0,0 +1,104 @@
+import os
+import time
+import hashlib
+import argparse
+import threading
+import metrics
+from dotenv import load_dotenv
+from db_pool import get_cursor
+
+load_dotenv()
+# Set COMPLETION_CACHE=0 to always call the providers
+COMPLETION_CACHE = os.getenv("COMPLETION_CACHE", "1") != "0"
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0, "spent_seconds": 0.0}
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).digest()
+
+
+def completion_cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def completion_cache_summary():
+    stats = completion_cache_stats()
+    return (f"Completion cache: {stats['hits']} calls saved "
+            f"(~{stats['saved_seconds']:.1f}s of LLM latency), "
+            f"{stats['misses']} calls made ({stats['spent_seconds']:.1f}s).")
+
+
+def cached_completion(provider, model, template, prompt, ask):
+    """
+    Returns the stored response for `prompt` if this provider and model
+    already answered it, otherwise calls `ask(prompt)` and stores the result
+    under `template` together with how long the call took.
+    """
+    if not COMPLETION_CACHE:
+        return ask(prompt)
+
+    key = (provider, model, prompt_hash(prompt))
+    with metrics.span("completion_cache_lookup", provider=provider) as span, get_cursor() as cur:
+        cur.execute(
+            """SELECT "response", "latency" FROM completion_cache WHERE "provider" = %s AND "model" = %s AND "prompt_hash" = %s""", key)
+        row = cur.fetchone()
+        span.add(rows=int(row is not None))
+    if row:
+        with _stats_lock:
+            _stats["hits"] += 1
+            _stats["saved_seconds"] += row[1] or 0
+        return row[0]
+
+    started = time.monotonic()
+    response = ask(prompt)
+    latency = time.monotonic() - started
+    with _stats_lock:
+        _stats["misses"] += 1
+        _stats["spent_seconds"] += latency
+
+    with get_cursor() as cur:
+        cur.execute("""
+            INSERT INTO completion_cache ("provider", "model", "prompt_hash", "template", "response", "latency")
+            VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""", (*key, template, response, latency))
+    return response
+
+
+def invalidate(templates, provider=None):
+    with get_cursor() as cur:
+        if provider:
+            cur.execute("""DELETE FROM completion_cache WHERE "template" = ANY(%s) AND "provider" = %s""",
+                        (templates, provider))
+        else:
+            cur.execute(
+                """DELETE FROM completion_cache WHERE "template" = ANY(%s)""", (templates,))
+        return cur.rowcount
+
+
+def print_stats():
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT "template", "provider", count(*), sum("latency")
+            FROM completion_cache GROUP BY 1, 2 ORDER BY 1, 2""")
+        for template, provider, entries, latency in cur.fetchall():
+            print(f"{template} ({provider}): {entries} responses, {latency or 0:.1f}s of LLM latency stored")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Inspect or invalidate cached LLM completions.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats")
+    invalidate_parser = subparsers.add_parser("invalidate")
+    invalidate_parser.add_argument("templates", nargs="+",
+                                   help="Prompt template names, e.g. FILE_PROMPT FOLDER_PROMPT.")
+    invalidate_parser.add_argument("--provider", choices=["openai", "ubicloud"])
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print_stats()
+    else:
+        deleted = invalidate(args.templates, args.provider)
+        print(f"Deleted {deleted} cached completions.")
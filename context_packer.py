@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import metrics
+from dotenv import load_dotenv
+from chunker import count_tokens
+
+load_dotenv()
+# Most tokens of retrieved context per prompt. Everything beyond a few thousand
+# tokens mostly adds latency, and Llama's window is the smaller one.
+CONTEXT_TOKEN_BUDGETS = {
+    "openai": int(os.getenv("OPENAI_CONTEXT_TOKENS", "8000")),
+    "ubicloud": int(os.getenv("UBICLOUD_CONTEXT_TOKENS", "6000")),
+}
+# Candidates fetched per requested result, to pick the requested number from
+PACK_OVERFETCH = int(os.getenv("PACK_OVERFETCH", "3"))
+# Candidates at least this cosine-similar to a better one are dropped
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", "0.95"))
+# Weight of relevance against novelty when picking the next candidate
+# (maximal marginal relevance); 1 ignores diversity altogether
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+
+
+def as_array(vector, dimensions):
+    if vector is None:
+        return np.zeros(dimensions, dtype=np.float32)
+    # pgvector's Vector, as the pooled connections return it
+    if hasattr(vector, "to_numpy"):
+        return vector.to_numpy()
+    return np.asarray(vector, dtype=np.float32)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def pack_context(question_vector, candidates, budget, limits=None, count=count_tokens):
+    """
+    Chooses which retrieved candidates go into the prompt.
+
+    `candidates` are (context_type, label, text, vector) tuples. Candidates
+    nearly identical to a more relevant one are dropped first. The rest are
+    picked by maximal marginal relevance (cosine similarity to the question,
+    minus similarity to what is already picked) until each type has its
+    number of rows in `limits`, skipping those that no longer fit in
+    `budget` tokens. The over-fetched candidates only widen the choice; the
+    budget is a ceiling, not a target.
+
+    Returns the picked texts, best first, and (label, reason) pairs for the
+    candidates left out.
+    """
+    if not candidates:
+        return [], []
+    dimensions = len(question_vector)
+    vectors = normalize([as_array(vector, dimensions) for _, _, _, vector in candidates])
+    relevance = vectors @ normalize(question_vector)
+    similarity = vectors @ vectors.T
+    tokens = [count(text) for _, _, text, _ in candidates]
+    left_per_type = dict(limits) if limits is not None else {}
+
+    dropped = []
+    remaining = []
+    for i in np.argsort(-relevance, kind="stable"):
+        duplicate_of = next((j for j in remaining if similarity[i, j] >= DUPLICATE_SIMILARITY), None)
+        if duplicate_of is None:
+            remaining.append(i)
+        else:
+            dropped.append((candidates[i][1], f"near-duplicate of {candidates[duplicate_of][1]}"))
+
+    picked = []
+    left = budget
+    while remaining:
+        if picked:
+            redundancy = similarity[np.ix_(remaining, picked)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining))
+        scores = MMR_LAMBDA * relevance[remaining] - (1 - MMR_LAMBDA) * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+        context_type = candidates[best][0]
+        if left_per_type.get(context_type, 1) <= 0:
+            dropped.append((candidates[best][1], f"beyond the {limits[context_type]} {context_type} asked for"))
+            continue
+        if tokens[best] > left:
+            dropped.append((candidates[best][1], f"over the token budget ({tokens[best]} tokens, {left} left)"))
+            continue
+        picked.append(best)
+        left -= tokens[best]
+        if context_type in left_per_type:
+            left_per_type[context_type] -= 1
+    metrics.add(tokens=budget - left, rows=len(picked))
+    return [candidates[i][2] for i in picked], dropped
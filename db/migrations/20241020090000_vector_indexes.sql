@@ -0,0 +1,17 @@
+-- migrate:up
+create index if not exists folders_vector_openai_idx on folders using hnsw ("vector_openai" vector_l2_ops);
+create index if not exists files_vector_openai_idx on files using hnsw ("vector_openai" vector_l2_ops);
+create index if not exists commits_vector_openai_idx on commits using hnsw ("vector_openai" vector_l2_ops);
+
+-- The primary keys of folders and files do not lead with "repo", so every
+-- repo-filtered scan would otherwise walk the whole table.
+create index if not exists folders_repo_idx on folders ("repo");
+create index if not exists files_repo_idx on files ("repo");
+
+-- migrate:down
+
+drop index if exists files_repo_idx;
+drop index if exists folders_repo_idx;
+drop index if exists commits_vector_openai_idx;
+drop index if exists files_vector_openai_idx;
+drop index if exists folders_vector_openai_idx;
@@ -0,0 +1,13 @@
+-- migrate:up
+-- vector_ubicloud has 4096 dimensions, which is over the limit for indexing
+-- vector and halfvec columns. Index its binary quantization instead; queries
+-- fetch candidates by Hamming distance and rerank them on the full vector.
+create index if not exists folders_vector_ubicloud_bq_idx on folders using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index if not exists files_vector_ubicloud_bq_idx on files using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index if not exists commits_vector_ubicloud_bq_idx on commits using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+
+-- migrate:down
+
+drop index if exists commits_vector_ubicloud_bq_idx;
+drop index if exists files_vector_ubicloud_bq_idx;
+drop index if exists folders_vector_ubicloud_bq_idx;
@@ -0,0 +1,11 @@
+-- migrate:up
+create table if not exists embedding_cache (
+    "model" text,
+    "text_hash" bytea,
+    "vector" vector,
+    primary key ("model", "text_hash")
+);
+
+-- migrate:down
+
+drop table embedding_cache;
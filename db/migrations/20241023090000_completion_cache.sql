@@ -0,0 +1,17 @@
+-- migrate:up
+create table if not exists completion_cache (
+    "provider" text,
+    "model" text,
+    "prompt_hash" bytea,
+    "template" text,
+    "response" text,
+    "latency" real,
+    "created_at" timestamptz default now(),
+    primary key ("provider", "model", "prompt_hash")
+);
+
+create index if not exists completion_cache_template_idx on completion_cache ("template");
+
+-- migrate:down
+
+drop table completion_cache;
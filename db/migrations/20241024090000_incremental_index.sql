@@ -0,0 +1,13 @@
+-- migrate:up
+-- Git blob id of the file contents the summary was generated from
+alter table files add column if not exists "content_hash" text;
+
+-- Commit the repository was last indexed at
+alter table repos add column if not exists "indexed_commit" text;
+alter table repos add column if not exists "indexed_at" timestamptz;
+
+-- migrate:down
+
+alter table repos drop column if exists "indexed_at";
+alter table repos drop column if exists "indexed_commit";
+alter table files drop column if exists "content_hash";
@@ -0,0 +1,24 @@
+-- migrate:up
+-- Full-text search columns for hybrid retrieval. The english configuration
+-- drops stop words but keeps dotted symbols such as cron.schedule whole.
+-- Adding a stored generated column rewrites the table.
+alter table files add column if not exists "search" tsvector generated always as (
+    setweight(to_tsvector('english', coalesce("name", '')), 'A') ||
+    setweight(to_tsvector('english', coalesce("llm_openai", '') || ' ' || coalesce("llm_ubicloud", '')), 'B') ||
+    -- tsvectors are limited to 1 MB, so only the start of large files is indexed
+    setweight(to_tsvector('english', left(coalesce("code", ''), 100000)), 'C')
+) stored;
+
+alter table commits add column if not exists "search" tsvector generated always as (
+    to_tsvector('english', coalesce("message", ''))
+) stored;
+
+create index if not exists files_search_idx on files using gin ("search");
+create index if not exists commits_search_idx on commits using gin ("search");
+
+-- migrate:down
+
+drop index if exists commits_search_idx;
+drop index if exists files_search_idx;
+alter table commits drop column if exists "search";
+alter table files drop column if exists "search";
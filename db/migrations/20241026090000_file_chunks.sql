@@ -0,0 +1,34 @@
+-- migrate:up
+-- Sections of files, a few hundred lines at most, each summarized and
+-- embedded on its own so retrieval can return the relevant lines of a large
+-- file instead of the whole file. Rows go with their file. Files indexed
+-- before this migration are chunked from their stored code, with their
+-- existing summaries kept, by the next `process_repo.py <repo> --incremental`.
+create table if not exists file_chunks (
+    "repo" text,
+    "folder" text,
+    "name" text,
+    "chunk" int,
+    "start_line" int,
+    "end_line" int,
+    "code" text,
+    "llm_openai" text,
+    "llm_ubicloud" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    "search" tsvector generated always as (
+        setweight(to_tsvector('english', coalesce("name", '')), 'A') ||
+        setweight(to_tsvector('english', coalesce("llm_openai", '') || ' ' || coalesce("llm_ubicloud", '')), 'B') ||
+        setweight(to_tsvector('english', coalesce("code", '')), 'C')
+    ) stored,
+    primary key ("repo", "folder", "name", "chunk"),
+    foreign key ("name", "folder", "repo") references files on delete cascade
+);
+
+create index if not exists file_chunks_vector_openai_idx on file_chunks using hnsw ("vector_openai" vector_l2_ops);
+create index if not exists file_chunks_vector_ubicloud_bq_idx on file_chunks using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index if not exists file_chunks_search_idx on file_chunks using gin ("search");
+
+-- migrate:down
+
+drop table if exists file_chunks;
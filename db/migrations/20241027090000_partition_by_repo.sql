@@ -0,0 +1,204 @@
+-- migrate:up
+-- Every query filters on "repo", so each repo gets its own partition of
+-- folders, files, commits and file_chunks, with its own vector and search
+-- indexes. A query for one repo then only reads that repo's heap and
+-- indexes, and removing a repo drops its tables instead of deleting rows.
+
+-- The name of `repo`'s partition of `parent`. The hash keeps names of repos
+-- that differ only in punctuation or past the first characters apart.
+create or replace function repo_partition(parent text, repo text) returns text
+language sql immutable as $$
+    select parent || '_' || left(regexp_replace(lower(repo), '[^a-z0-9]+', '_', 'g'), 16) || '_' || left(md5(repo), 6)
+$$;
+
+-- Creates whichever of `repo`'s partitions are missing, with their indexes.
+-- The tables are created on their own and then attached, which only needs a
+-- SHARE UPDATE EXCLUSIVE lock on the parents, so queries keep running.
+create or replace function create_repo_partitions(repo text) returns void
+language plpgsql as $$
+declare
+    parent text;
+    partition text;
+begin
+    -- files before file_chunks, whose rows reference them
+    foreach parent in array array['folders', 'files', 'commits', 'file_chunks'] loop
+        partition := repo_partition(parent, repo);
+        if to_regclass(partition) is not null then
+            continue;
+        end if;
+        execute format('create table %I (like %I including all)', partition, parent);
+        execute format('alter table %I attach partition %I for values in (%L)', parent, partition, repo);
+        execute format('create index %I on %I using hnsw ("vector_openai" vector_l2_ops)',
+                       partition || '_vector_openai_idx', partition);
+        execute format('create index %I on %I using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops)',
+                       partition || '_vector_ubicloud_bq_idx', partition);
+        if parent <> 'folders' then
+            execute format('create index %I on %I using gin ("search")', partition || '_search_idx', partition);
+        end if;
+    end loop;
+end
+$$;
+
+-- Removes everything indexed for `repo` by dropping its partitions.
+create or replace function drop_repo_partitions(repo text) returns void
+language plpgsql as $$
+declare
+    parent text;
+    partition text;
+begin
+    foreach parent in array array['file_chunks', 'commits', 'files', 'folders'] loop
+        partition := repo_partition(parent, repo);
+        if to_regclass(partition) is not null then
+            execute format('alter table %I detach partition %I', parent, partition);
+            execute format('drop table %I', partition);
+        end if;
+    end loop;
+    delete from repos where "name" = repo;
+end
+$$;
+
+alter table file_chunks drop constraint if exists file_chunks_name_folder_repo_fkey;
+alter table folders rename to folders_unpartitioned;
+alter table files rename to files_unpartitioned;
+alter table commits rename to commits_unpartitioned;
+alter table file_chunks rename to file_chunks_unpartitioned;
+alter table folders_unpartitioned rename constraint folders_pkey to folders_unpartitioned_pkey;
+alter table files_unpartitioned rename constraint files_pkey to files_unpartitioned_pkey;
+alter table commits_unpartitioned rename constraint commits_pkey to commits_unpartitioned_pkey;
+alter table file_chunks_unpartitioned rename constraint file_chunks_pkey to file_chunks_unpartitioned_pkey;
+
+create table folders (
+    "repo" text,
+    "name" text,
+    "llm_openai" text,
+    "llm_ubicloud" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    primary key ("name", "repo")
+) partition by list ("repo");
+
+create table files (
+    "repo" text,
+    "folder" text,
+    "name" text,
+    "code" text,
+    "llm_openai" text,
+    "llm_ubicloud" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    "content_hash" text,
+    "search" tsvector generated always as (
+        setweight(to_tsvector('english', coalesce("name", '')), 'A') ||
+        setweight(to_tsvector('english', coalesce("llm_openai", '') || ' ' || coalesce("llm_ubicloud", '')), 'B') ||
+        setweight(to_tsvector('english', left(coalesce("code", ''), 100000)), 'C')
+    ) stored,
+    primary key ("name", "folder", "repo")
+) partition by list ("repo");
+
+create table commits (
+    "repo" text,
+    "id" text,
+    "author" text,
+    "date" text,
+    "changes" text,
+    "message" text,
+    "llm_openai" text,
+    "llm_ubicloud" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    "search" tsvector generated always as (
+        to_tsvector('english', coalesce("message", ''))
+    ) stored,
+    primary key ("repo", "id")
+) partition by list ("repo");
+
+create table file_chunks (
+    "repo" text,
+    "folder" text,
+    "name" text,
+    "chunk" int,
+    "start_line" int,
+    "end_line" int,
+    "code" text,
+    "llm_openai" text,
+    "llm_ubicloud" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    "search" tsvector generated always as (
+        setweight(to_tsvector('english', coalesce("name", '')), 'A') ||
+        setweight(to_tsvector('english', coalesce("llm_openai", '') || ' ' || coalesce("llm_ubicloud", '')), 'B') ||
+        setweight(to_tsvector('english', coalesce("code", '')), 'C')
+    ) stored,
+    primary key ("repo", "folder", "name", "chunk"),
+    foreign key ("name", "folder", "repo") references files on delete cascade
+) partition by list ("repo");
+
+select create_repo_partitions(repo) from (
+    select "name" as repo from repos
+    union select "repo" from folders_unpartitioned
+    union select "repo" from files_unpartitioned
+    union select "repo" from commits_unpartitioned
+) repos where repo is not null;
+
+insert into folders select * from folders_unpartitioned;
+insert into files ("repo", "folder", "name", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud", "content_hash")
+    select "repo", "folder", "name", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud", "content_hash" from files_unpartitioned;
+insert into commits ("repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud")
+    select "repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud" from commits_unpartitioned;
+insert into file_chunks ("repo", "folder", "name", "chunk", "start_line", "end_line", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud")
+    select "repo", "folder", "name", "chunk", "start_line", "end_line", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud" from file_chunks_unpartitioned;
+
+drop table file_chunks_unpartitioned;
+drop table commits_unpartitioned;
+drop table files_unpartitioned;
+drop table folders_unpartitioned;
+
+-- migrate:down
+
+alter table file_chunks rename to file_chunks_partitioned;
+alter table commits rename to commits_partitioned;
+alter table files rename to files_partitioned;
+alter table folders rename to folders_partitioned;
+alter table file_chunks_partitioned rename constraint file_chunks_pkey to file_chunks_partitioned_pkey;
+alter table commits_partitioned rename constraint commits_pkey to commits_partitioned_pkey;
+alter table files_partitioned rename constraint files_pkey to files_partitioned_pkey;
+alter table folders_partitioned rename constraint folders_pkey to folders_partitioned_pkey;
+
+create table folders (like folders_partitioned including defaults including generated, primary key ("name", "repo"));
+create table files (like files_partitioned including defaults including generated, primary key ("name", "folder", "repo"));
+create table commits (like commits_partitioned including defaults including generated, primary key ("repo", "id"));
+create table file_chunks (
+    like file_chunks_partitioned including defaults including generated,
+    primary key ("repo", "folder", "name", "chunk"),
+    foreign key ("name", "folder", "repo") references files on delete cascade
+);
+
+insert into folders select * from folders_partitioned;
+insert into files ("repo", "folder", "name", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud", "content_hash")
+    select "repo", "folder", "name", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud", "content_hash" from files_partitioned;
+insert into commits ("repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud")
+    select "repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud" from commits_partitioned;
+insert into file_chunks ("repo", "folder", "name", "chunk", "start_line", "end_line", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud")
+    select "repo", "folder", "name", "chunk", "start_line", "end_line", "code", "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud" from file_chunks_partitioned;
+
+drop table file_chunks_partitioned;
+drop table commits_partitioned;
+drop table files_partitioned;
+drop table folders_partitioned;
+drop function drop_repo_partitions(text);
+drop function create_repo_partitions(text);
+drop function repo_partition(text, text);
+
+create index folders_repo_idx on folders ("repo");
+create index files_repo_idx on files ("repo");
+create index folders_vector_openai_idx on folders using hnsw ("vector_openai" vector_l2_ops);
+create index files_vector_openai_idx on files using hnsw ("vector_openai" vector_l2_ops);
+create index commits_vector_openai_idx on commits using hnsw ("vector_openai" vector_l2_ops);
+create index file_chunks_vector_openai_idx on file_chunks using hnsw ("vector_openai" vector_l2_ops);
+create index folders_vector_ubicloud_bq_idx on folders using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index files_vector_ubicloud_bq_idx on files using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index commits_vector_ubicloud_bq_idx on commits using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index file_chunks_vector_ubicloud_bq_idx on file_chunks using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index files_search_idx on files using gin ("search");
+create index commits_search_idx on commits using gin ("search");
+create index file_chunks_search_idx on file_chunks using gin ("search");
@@ -0,0 +1,33 @@
+-- migrate:up
+-- Answers given in the app, found again by the embedding of their question,
+-- so a repeated or reworded question is answered without retrieval or a
+-- completion. An entry only holds for the "indexed_at" of its repo it was
+-- answered from, and goes with the repo.
+create table if not exists answer_cache (
+    "id" bigserial primary key,
+    "provider" text,
+    "model" text,
+    "repo" text references repos on delete cascade,
+    "context_types" text,
+    "indexed_at" timestamptz,
+    "question" text,
+    "vector_openai" vector(1536),
+    "vector_ubicloud" vector(4096),
+    "prompt" text,
+    "answer" text,
+    "hits" int default 0,
+    "created_at" timestamptz default now(),
+    "used_at" timestamptz default now()
+);
+
+create index if not exists answer_cache_vector_openai_idx on answer_cache using hnsw ("vector_openai" vector_cosine_ops);
+create index if not exists answer_cache_vector_ubicloud_bq_idx on answer_cache using hnsw ((binary_quantize("vector_ubicloud")::bit(4096)) bit_hamming_ops);
+create index if not exists answer_cache_used_at_idx on answer_cache ("used_at");
+
+-- Entries are only kept for a repo's "indexed_at", which repos indexed before
+-- it was recorded do not have yet
+update repos set "indexed_at" = now() where "indexed_at" is null;
+
+-- migrate:down
+
+drop table answer_cache;
@@ -0,0 +1,151 @@
+import os
+import time
+import atexit
+import threading
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+# psycopg2 keeps at most DB_POOL_MIN_SIZE idle connections open; connections
+# opened above that to serve bursts are closed when they are returned.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Connections idle for longer than this many seconds are pinged before reuse
+DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it runs out of
+# connections, so callers queue on this semaphore first.
+_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+_roundtrips = 0
+_roundtrips_lock = threading.Lock()
+
+
+def db_roundtrips():
+    """
+    Returns how many statements the pooled connections, and the other
+    connections opened with CountingCursor, have sent so far.
+    """
+    return _roundtrips
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def count(self, statements=1):
+        global _roundtrips
+        with _roundtrips_lock:
+            _roundtrips += statements
+
+    def execute(self, query, vars=None):
+        self.count()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        # psycopg2 sends one statement per parameter set
+        vars_list = list(vars_list)
+        self.count(len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.count()
+        return super().copy_expert(sql, file, size)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    A connection that registers the vector types once, when it is opened, and
+    remembers which statements it has prepared.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+        register_vector(self)
+        self.commit()
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL,
+                    connection_factory=PooledConnection)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+atexit.register(close_pool)
+
+
+def is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_POOL_HEALTH_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def get_connection():
+    with _slots:
+        pool = get_pool()
+        conn = pool.getconn()
+        while not is_healthy(conn):
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            conn.last_used = time.monotonic()
+            pool.putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def get_cursor():
+    with get_connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def execute_prepared(cur, name, param_types, query, params):
+    """
+    Executes `query` as the server-side prepared statement `name`, preparing it
+    on first use on this connection. `query` uses $1..$n placeholders.
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(
+            f"PREPARE {name} ({', '.join(param_types)}) AS {query}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
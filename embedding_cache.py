@@ -0,0 +1,135 @@
+import os
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from dotenv import load_dotenv
+from db_pool import get_cursor
+from vector_writer import insert_rows
+
+load_dotenv()
+# Set EMBEDDING_CACHE=0 to always call the providers, or EMBEDDING_CACHE_DB=0
+# to keep only the in-process cache
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "1") != "0"
+# Entries kept in memory; a 4096-dim float32 vector takes 16 KB
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2000"))
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+_stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "duplicates": 0}
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def embedding_cache_stats():
+    with _lru_lock:
+        return dict(_stats, memory_entries=len(_lru))
+
+
+def count(stat, n):
+    with _lru_lock:
+        _stats[stat] += n
+
+
+def lru_get(key):
+    with _lru_lock:
+        vector = _lru.get(key)
+        if vector is not None:
+            _lru.move_to_end(key)
+        return vector
+
+
+def lru_put(key, vector):
+    with _lru_lock:
+        _lru[key] = vector
+        _lru.move_to_end(key)
+        while len(_lru) > EMBEDDING_CACHE_SIZE:
+            _lru.popitem(last=False)
+
+
+def db_get(model, hashes):
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "text_hash", "vector" FROM embedding_cache WHERE "model" = %s AND "text_hash" = ANY(%s)""",
+            (model, hashes))
+        return {bytes(h): vector.to_numpy() for h, vector in cur.fetchall()}
+
+
+def db_put(model, vectors):
+    with get_cursor() as cur:
+        insert_rows(cur, "embedding_cache", ["model", "text_hash", "vector"],
+                    [(model, h, vector) for h, vector in vectors.items()],
+                    ["model", "text_hash"])
+
+
+def cache_lookup(model, texts):
+    """
+    Returns the hashes of `texts`, each distinct text by hash, the vectors
+    found in memory or in the embedding_cache table, and the hashes of the
+    texts still to embed.
+    """
+    hashes = [text_hash(text) for text in texts]
+    unique = dict(zip(hashes, texts))
+    count("duplicates", len(texts) - len(unique))
+
+    found = {}
+    for h in unique:
+        vector = lru_get((model, h))
+        if vector is not None:
+            found[h] = vector
+    count("memory_hits", len(found))
+
+    missing = [h for h in unique if h not in found]
+    if missing and EMBEDDING_CACHE_DB:
+        stored = db_get(model, missing)
+        count("db_hits", len(stored))
+        found.update(stored)
+        for h, vector in stored.items():
+            lru_put((model, h), vector)
+        missing = [h for h in missing if h not in stored]
+    return hashes, unique, found, missing
+
+
+def cache_store(model, found, missing, vectors):
+    count("misses", len(missing))
+    embedded = {h: np.asarray(vector, dtype=np.float32) for h, vector in zip(missing, vectors)}
+    if EMBEDDING_CACHE_DB:
+        db_put(model, embedded)
+    found.update(embedded)
+    for h, vector in embedded.items():
+        lru_put((model, h), vector)
+
+
+def cached_embeddings(model, texts, embed):
+    """
+    Returns the embeddings of `texts` under `model`, calling `embed` (a
+    function from a list of texts to their embeddings) only for texts found
+    neither in memory nor in the embedding_cache table. Each distinct text is
+    looked up and embedded once, however often it repeats in `texts`.
+    """
+    if not EMBEDDING_CACHE:
+        return embed(texts)
+
+    hashes, unique, found, missing = cache_lookup(model, texts)
+    if missing:
+        cache_store(model, found, missing, embed([unique[h] for h in missing]))
+    return [found[h].tolist() for h in hashes]
+
+
+async def cached_embeddings_async(model, texts, embed):
+    """
+    cached_embeddings for a coroutine `embed`. The cache is read and written
+    from a thread, as the table is reached through the blocking pool.
+    """
+    if not EMBEDDING_CACHE:
+        return await embed(texts)
+
+    hashes, unique, found, missing = await asyncio.to_thread(cache_lookup, model, texts)
+    if missing:
+        vectors = await embed([unique[h] for h in missing])
+        await asyncio.to_thread(cache_store, model, found, missing, vectors)
+    return [found[h].tolist() for h in hashes]
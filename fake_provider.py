@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+import numpy as np
+import metrics
+from rate_limiter import ProviderError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+# Seconds each fake call takes, give or take FAKE_LATENCY_JITTER of it, and
+# the share of calls that fail
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+FAKE_EMBEDDING_LATENCY = float(os.getenv("FAKE_EMBEDDING_LATENCY", "0"))
+FAKE_LATENCY_JITTER = float(os.getenv("FAKE_LATENCY_JITTER", "0.2"))
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+# Status of the injected errors; 429 and 5xx ones are retried
+FAKE_ERROR_STATUS = int(os.getenv("FAKE_ERROR_STATUS", "429"))
+# Pieces a streamed fake answer is split into
+FAKE_STREAM_CHUNKS = 8
+# Embedding dimensions per model name, for the HTTP server
+MODEL_DIMENSIONS = {"text-embedding-3-small": 1536, "e5-mistral-7b-it": 4096}
+
+SUMMARY_TEMPLATES = [
+    "This code handles {words}. It is a small, self-contained part of the repository.",
+    "Implements {words}, with helpers for the surrounding module.",
+    "Defines {words} and the logic that ties them together.",
+    "Covers {words}; most of the work happens in a few central functions.",
+]
+
+_random = random.Random(int(os.getenv("FAKE_SEED", "0")))
+_stats_lock = threading.Lock()
+_stats = {"completions": 0, "embedding_requests": 0, "embedded_texts": 0, "errors": 0}
+
+
+def fake_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def count(stat, n=1):
+    with _stats_lock:
+        _stats[stat] += n
+
+
+def delay(latency):
+    with _stats_lock:
+        jitter = _random.uniform(-FAKE_LATENCY_JITTER, FAKE_LATENCY_JITTER)
+        failed = _random.random() < FAKE_ERROR_RATE
+    if failed:
+        count("errors")
+    return max(0.0, latency * (1 + jitter)), failed
+
+
+def simulate(latency):
+    seconds, failed = delay(latency)
+    time.sleep(seconds)
+    if failed:
+        raise ProviderError(FAKE_ERROR_STATUS, "Injected fake provider error")
+
+
+async def simulate_async(latency):
+    seconds, failed = delay(latency)
+    await asyncio.sleep(seconds)
+    if failed:
+        raise ProviderError(FAKE_ERROR_STATUS, "Injected fake provider error")
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def pseudo_embedding(text, dimensions):
+    """
+    A unit vector that depends only on `text`, so equal texts embed equally.
+    """
+    rng = np.random.default_rng(np.frombuffer(digest(text), dtype=np.uint32))
+    vector = rng.standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def canned_summary(provider, prompt):
+    """
+    A deterministic summary that mentions some words of the prompt, so
+    lexical search over fake summaries still finds something.
+    """
+    words = [word for word in prompt.split() if word.isalnum() and len(word) > 3]
+    h = digest(provider + prompt)
+    picked = [words[(h[i] * 256 + h[i + 1]) % len(words)] for i in range(0, 6, 2)] if words else ["nothing"]
+    return SUMMARY_TEMPLATES[h[7] % len(SUMMARY_TEMPLATES)].format(words=", ".join(dict.fromkeys(picked)))
+
+
+def stream_pieces(text):
+    size = max(1, -(-len(text) // FAKE_STREAM_CHUNKS))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def embedder(dimensions):
+    def embed_batch(texts: list) -> list:
+        simulate(FAKE_EMBEDDING_LATENCY)
+        count("embedding_requests")
+        count("embedded_texts", len(texts))
+        metrics.add(rows=len(texts))
+        return [pseudo_embedding(text, dimensions) for text in texts]
+    return embed_batch
+
+
+def async_embedder(dimensions):
+    async def embed_batch(texts: list) -> list:
+        await simulate_async(FAKE_EMBEDDING_LATENCY)
+        count("embedding_requests")
+        count("embedded_texts", len(texts))
+        metrics.add(rows=len(texts))
+        return [pseudo_embedding(text, dimensions) for text in texts]
+    return embed_batch
+
+
+def asker(provider):
+    def ask(prompt: str) -> str:
+        simulate(FAKE_LLM_LATENCY)
+        count("completions")
+        answer = canned_summary(provider, prompt)
+        metrics.add(bytes=len(prompt.encode("utf-8")) + len(answer.encode("utf-8")))
+        return answer
+    return ask
+
+
+def stream_asker(provider):
+    def ask(prompt: str):
+        pieces = stream_pieces(canned_summary(provider, prompt))
+        simulate(FAKE_LLM_LATENCY / 2)
+        count("completions")
+        for piece in pieces:
+            time.sleep(FAKE_LLM_LATENCY / 2 / len(pieces))
+            yield piece
+    return ask
+
+
+def async_stream_asker(provider):
+    async def ask(prompt: str):
+        pieces = stream_pieces(canned_summary(provider, prompt))
+        await simulate_async(FAKE_LLM_LATENCY / 2)
+        count("completions")
+        for piece in pieces:
+            await asyncio.sleep(FAKE_LLM_LATENCY / 2 / len(pieces))
+            yield piece
+    return ask
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """
+    Serves /v1/embeddings and /v1/chat/completions in the shape of the OpenAI
+    and Ubicloud APIs, streamed or not, with the same fake data and latency.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "")
+        try:
+            if self.path.endswith("/embeddings"):
+                self.embeddings(body, model)
+            elif self.path.endswith("/chat/completions"):
+                self.completions(body, model)
+            else:
+                self.send_json(404, {"error": {"message": f"No fake endpoint at {self.path}"}})
+        except ProviderError as e:
+            self.send_json(e.status, {"error": {"message": str(e)}})
+        except Exception as e:
+            self.send_json(500, {"error": {"message": str(e)}})
+
+    def embeddings(self, body, model):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or MODEL_DIMENSIONS.get(model, 1536)
+        vectors = embedder(dimensions)(texts)
+        if body.get("encoding_format") == "base64":
+            vectors = [base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode()
+                       for vector in vectors]
+        self.send_json(200, {
+            "object": "list", "model": model,
+            "data": [{"object": "embedding", "index": i, "embedding": vector}
+                     for i, vector in enumerate(vectors)],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    def completions(self, body, model):
+        prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        created = int(time.time())
+        if not body.get("stream"):
+            answer = asker(model)(prompt)
+            self.send_json(200, {
+                "id": "fake", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+        pieces = stream_asker(model)(prompt)
+        first = next(pieces)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in [first, *pieces]:
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.send_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def serve(port=0):
+    """
+    Starts the fake API server on a background thread and returns it; its
+    base URL is http://127.0.0.1:<server.server_port>/v1.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeAPIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve fake OpenAI- and Ubicloud-compatible endpoints.")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+    server = serve(args.port)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    print(f"Fake provider API at {base_url}. Point the app at it with:")
+    print(f"  OPENAI_BASE_URL={base_url}")
+    print(f"  UBICLOUD_LLM_API_URL={base_url}/chat/completions")
+    print(f"  UBICLOUD_VECTOR_API_URL={base_url}/embeddings")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import contextvars
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+# Set METRICS=0 to skip all timing; instrumented functions are then left
+# unwrapped and spans do nothing
+METRICS = os.getenv("METRICS", "1") != "0"
+# Port of the Prometheus endpoint the app serves; 0 turns it off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# If set, the ingestion CLIs also write their run summary there as JSON
+METRICS_SUMMARY_FILE = os.getenv("METRICS_SUMMARY_FILE")
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30, 60, 120)
+# Durations kept per stage for the percentiles in the run summary
+SUMMARY_SAMPLES = 1000
+COUNTS = ("tokens", "bytes", "rows")
+
+_stages = {}
+_stages_lock = threading.Lock()
+_current = contextvars.ContextVar("metrics_span", default=None)
+
+
+class Stage:
+    __slots__ = ("buckets", "sum", "count", "errors", "totals", "samples")
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self.totals = dict.fromkeys(COUNTS, 0)
+        self.samples = deque(maxlen=SUMMARY_SAMPLES)
+
+
+def observe(stage, labels, seconds, counts, failed=False):
+    key = (stage, labels)
+    with _stages_lock:
+        metric = _stages.get(key)
+        if metric is None:
+            metric = _stages[key] = Stage()
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                metric.buckets[i] += 1
+                break
+        metric.sum += seconds
+        metric.count += 1
+        metric.errors += failed
+        metric.samples.append(seconds)
+        for name, value in counts.items():
+            metric.totals[name] += value
+
+
+class Span:
+    """
+    Times one run of a stage. Counts (tokens, bytes, rows) are added to it
+    with `add`, or with the module-level `add` by code running inside it.
+    """
+    __slots__ = ("stage", "labels", "bind", "counts", "started", "token")
+
+    def __init__(self, stage, labels, bind=True):
+        self.stage = stage
+        self.labels = labels
+        self.bind = bind
+        self.counts = {}
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        if self.bind:
+            self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.bind:
+            _current.reset(self.token)
+        # A generator closed before its end is not a failure
+        failed = exc_type is not None and not issubclass(exc_type, GeneratorExit)
+        observe(self.stage, self.labels, time.perf_counter() - self.started,
+                self.counts, failed)
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+_noop = NoopSpan()
+
+
+def span(stage, bind=True, **labels):
+    """
+    A context manager timing `stage`, labelled with `labels`. Spans that are
+    not bound (for generators, which may be resumed from another context) do
+    not receive counts from the module-level `add`.
+    """
+    if not METRICS:
+        return _noop
+    return Span(stage, tuple(sorted(labels.items())), bind)
+
+
+def add(**counts):
+    """
+    Adds counts to the innermost span of the calling thread or task.
+    """
+    if METRICS:
+        current = _current.get()
+        if current is not None:
+            current.add(**counts)
+
+
+def text_bytes(text):
+    return len(text.encode("utf-8")) if isinstance(text, str) else 0
+
+
+def timed(stage, **labels):
+    """
+    Decorates a function, coroutine function, or (async) generator function
+    so that each call is a span of `stage`. For generators, the time to the
+    first item is also recorded, as `<stage>_first_item`, and the bytes of
+    the text they yield are counted.
+    """
+    def decorate(fn):
+        if not METRICS:
+            return fn
+
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(stage, bind=False, **labels) as s:
+                    first = True
+                    async for item in fn(*args, **kwargs):
+                        if first:
+                            first = False
+                            observe(f"{stage}_first_item", s.labels,
+                                    time.perf_counter() - s.started, {})
+                        s.add(bytes=text_bytes(item))
+                        yield item
+        elif inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(stage, bind=False, **labels) as s:
+                    first = True
+                    for item in fn(*args, **kwargs):
+                        if first:
+                            first = False
+                            observe(f"{stage}_first_item", s.labels,
+                                    time.perf_counter() - s.started, {})
+                        s.add(bytes=text_bytes(item))
+                        yield item
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(stage, **labels):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(stage, **labels):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    with _stages_lock:
+        return {key: (list(metric.buckets), metric.sum, metric.count, metric.errors,
+                      dict(metric.totals), list(metric.samples))
+                for key, metric in _stages.items()}
+
+
+def format_labels(stage, labels, extra=()):
+    pairs = [("stage", stage), *labels, *extra]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def prometheus_text():
+    """
+    Renders every stage in the Prometheus text exposition format: a duration
+    histogram, and error, token, byte and row counters.
+    """
+    stages = sorted(snapshot().items())
+    lines = ["# HELP pgconf_stage_duration_seconds Time spent per stage.",
+             "# TYPE pgconf_stage_duration_seconds histogram"]
+    for (stage, labels), (buckets, total, count, _, _, _) in stages:
+        cumulative = 0
+        for bound, n in zip(DURATION_BUCKETS, buckets):
+            cumulative += n
+            lines.append(f"pgconf_stage_duration_seconds_bucket"
+                         f"{format_labels(stage, labels, [('le', bound)])} {cumulative}")
+        lines.append(f"pgconf_stage_duration_seconds_bucket"
+                     f"{format_labels(stage, labels, [('le', '+Inf')])} {count}")
+        lines.append(f"pgconf_stage_duration_seconds_sum{format_labels(stage, labels)} {total}")
+        lines.append(f"pgconf_stage_duration_seconds_count{format_labels(stage, labels)} {count}")
+    for name in ("errors", *COUNTS):
+        lines.append(f"# HELP pgconf_stage_{name}_total {name.capitalize()} per stage.")
+        lines.append(f"# TYPE pgconf_stage_{name}_total counter")
+        for (stage, labels), (_, _, _, errors, totals, _) in stages:
+            value = errors if name == "errors" else totals[name]
+            lines.append(f"pgconf_stage_{name}_total{format_labels(stage, labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary_stats():
+    stats = {}
+    for (stage, labels), (_, total, count, errors, totals, samples) in snapshot().items():
+        samples.sort()
+        name = " ".join([stage, *(str(value) for _, value in labels)])
+        stats[name] = {"count": count, "errors": errors, "seconds": total,
+                       "p50": samples[len(samples) // 2] if samples else 0,
+                       "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0,
+                       **totals}
+    return stats
+
+
+def summary():
+    """
+    A per-stage table of calls, total and percentile durations and counts,
+    for the end of a CLI run. Also written to METRICS_SUMMARY_FILE if set.
+    """
+    if not METRICS:
+        return "Metrics disabled."
+    stats = summary_stats()
+    if METRICS_SUMMARY_FILE:
+        with open(METRICS_SUMMARY_FILE, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    lines = [f"{'stage':<48} {'calls':>7} {'errors':>6} {'total s':>9} {'p50 s':>7} {'p95 s':>7} "
+             f"{'tokens':>9} {'bytes':>11} {'rows':>8}"]
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(f"{name:<48} {s['count']:>7} {s['errors']:>6} {s['seconds']:>9.2f} "
+                     f"{s['p50']:>7.3f} {s['p95']:>7.3f} {s['tokens']:>9} {s['bytes']:>11} {s['rows']:>8}")
+    return "\n".join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        data = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(port=METRICS_PORT):
+    """
+    Serves /metrics on `port` from a background thread of this process.
+    """
+    if not METRICS or not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,55 +1,194 @@
 import os
-import requests
-from openai import OpenAI
+import json
+import metrics
+import rate_limiter
+import ubicloud_client
+from chunker import approximate_tokens
+from rate_limiter import ProviderError
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+from embedding_cache import cached_embeddings, cached_embeddings_async
 load_dotenv()
+# "live" calls the providers; "fake" answers in-process with fake_provider,
+# without network access or API keys
+LLM_BACKEND = os.getenv("LLM_BACKEND", "live")
 
 
-# Open AI
-OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_KEY)
+# Open AI; OPENAI_BASE_URL, which the client reads itself, can point it
+# elsewhere, such as at `python fake_provider.py`
+OPENAI_KEY = os.getenv("OPENAI_API_KEY") or ("fake" if LLM_BACKEND != "live" else None)
+# Retries are left to rate_limiter, which paces them against the limits
+client = OpenAI(api_key=OPENAI_KEY, max_retries=0)
+async_client = AsyncOpenAI(api_key=OPENAI_KEY, max_retries=0)
 OPENAI_LLM_MODEL = "gpt-4o-mini"
 OPENAI_VECTOR_MODEL = "text-embedding-3-small"
+OPENAI_VECTOR_DIMENSIONS = 1536
 OPENAI_CONTEXT_WINDOW = 128000
 
 # Ubicloud
-UBICLOUD_LLM_API_URL = 'https://llama-3-2-3b-it.ai.ubicloud.com/v1/chat/completions'
-UBICLOUD_VECTOR_API_URL = 'https://e5-mistral-7b-it.ai.ubicloud.com/v1/embeddings'
+UBICLOUD_LLM_API_URL = os.getenv(
+    "UBICLOUD_LLM_API_URL", 'https://llama-3-2-3b-it.ai.ubicloud.com/v1/chat/completions')
+UBICLOUD_VECTOR_API_URL = os.getenv(
+    "UBICLOUD_VECTOR_API_URL", 'https://e5-mistral-7b-it.ai.ubicloud.com/v1/embeddings')
 UBICLOUD_API_KEY = os.getenv("UBICLOUD_API_KEY")
 UBICLOUD_CONTEXT_WINDOW = 90000
 UBICLOUD_LLM_MODEL = "llama-3-2-3b-it"
 UBICLOUD_VECTOR_MODEL = "e5-mistral-7b-it"
+UBICLOUD_VECTOR_DIMENSIONS = 4096
 
+# Embedding requests are split by item count and by total characters, which
+# stand in for the per-request token limits of each endpoint.
+OPENAI_EMBEDDING_BATCH_SIZE = 256
+OPENAI_EMBEDDING_BATCH_CHARS = 400000
+UBICLOUD_EMBEDDING_BATCH_SIZE = 32
+UBICLOUD_EMBEDDING_BATCH_CHARS = 100000
+# Answer tokens counted against the tokens-per-minute limit up front, on top
+# of the prompt
+COMPLETION_TOKENS_ESTIMATE = 500
 
-def generate_openai_embedding(text: str) -> list:
-    response = client.embeddings.create(model=OPENAI_VECTOR_MODEL, input=text)
-    embedding = response.data[0].embedding
-    return embedding
 
+def split_batches(texts, max_items, max_chars):
+    batch = []
+    batch_chars = 0
+    for text in texts:
+        if batch and (len(batch) >= max_items or batch_chars + len(text) > max_chars):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(text)
+        batch_chars += len(text)
+    if batch:
+        yield batch
 
-def generate_ubicloud_embedding(text: str) -> list:
-    headers = {
+
+def embed_batches(texts, embed_batch, max_items, max_chars):
+    """
+    Embeds `texts` in order, one request per batch. A failed batch is retried
+    on its own by the rate limiter, without re-sending earlier batches.
+    """
+    embeddings = []
+    for batch in split_batches(texts, max_items, max_chars):
+        embeddings.extend(embed_batch(batch))
+    return embeddings
+
+
+async def embed_batches_async(texts, embed_batch, max_items, max_chars):
+    embeddings = []
+    for batch in split_batches(texts, max_items, max_chars):
+        embeddings.extend(await embed_batch(batch))
+    return embeddings
+
+
+def text_bytes(texts):
+    return sum(len(text.encode("utf-8")) for text in texts)
+
+
+def embedding_tokens(texts):
+    return sum(approximate_tokens(text) for text in texts)
+
+
+def completion_tokens(prompt):
+    return approximate_tokens(prompt) + COMPLETION_TOKENS_ESTIMATE
+
+
+def provider_call(stage, provider, model, tokens):
+    """
+    Times a provider call as `stage` and paces and retries it within the
+    rate limits of `model`, `tokens(*args)` being its estimated usage.
+    """
+    def decorate(fn):
+        return metrics.timed(stage, provider=provider)(
+            rate_limiter.limited(provider, model, tokens)(fn))
+    return decorate
+
+
+@provider_call("embedding_request", "openai", OPENAI_VECTOR_MODEL, embedding_tokens)
+def embed_openai_batch(texts: list) -> list:
+    raw = client.embeddings.with_raw_response.create(model=OPENAI_VECTOR_MODEL, input=texts)
+    rate_limiter.update("openai", OPENAI_VECTOR_MODEL, raw.headers)
+    response = raw.parse()
+    metrics.add(rows=len(texts), bytes=text_bytes(texts),
+                tokens=response.usage.total_tokens if response.usage else 0)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def ubicloud_headers():
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {UBICLOUD_API_KEY}"
     }
 
+
+def ubicloud_embeddings(response) -> list:
+    rate_limiter.update("ubicloud", UBICLOUD_VECTOR_MODEL, response.headers)
+    if response.status_code != 200:
+        raise ProviderError(response.status_code, response.text, response.headers)
+
+    metrics.add(bytes=len(response.content))
+    response = response.json()
+    metrics.add(tokens=(response.get("usage") or {}).get("total_tokens", 0))
+    items = sorted(response['data'], key=lambda item: item.get('index', 0))
+    return [item['embedding'] for item in items]
+
+
+@provider_call("embedding_request", "ubicloud", UBICLOUD_VECTOR_MODEL, embedding_tokens)
+def embed_ubicloud_batch(texts: list) -> list:
+    metrics.add(rows=len(texts))
+    data = {
+        "model": UBICLOUD_VECTOR_MODEL,
+        "input": texts
+    }
+    return ubicloud_embeddings(ubicloud_client.post(
+        "embedding", UBICLOUD_VECTOR_API_URL, headers=ubicloud_headers(), json=data))
+
+
+@provider_call("embedding_request", "ubicloud", UBICLOUD_VECTOR_MODEL, embedding_tokens)
+async def embed_ubicloud_batch_async(texts: list) -> list:
+    metrics.add(rows=len(texts))
     data = {
         "model": UBICLOUD_VECTOR_MODEL,
-        "input": text
+        "input": texts
     }
+    return ubicloud_embeddings(await ubicloud_client.async_post(
+        "embedding", UBICLOUD_VECTOR_API_URL, headers=ubicloud_headers(), json=data))
 
-    response = requests.post(UBICLOUD_VECTOR_API_URL,
-                             headers=headers, json=data)
 
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+@metrics.timed("embedding", provider="openai")
+def generate_openai_embeddings(texts: list) -> list:
+    metrics.add(rows=len(texts))
+    return cached_embeddings(OPENAI_VECTOR_MODEL, texts, lambda misses: embed_batches(
+        misses, embed_openai_batch, OPENAI_EMBEDDING_BATCH_SIZE, OPENAI_EMBEDDING_BATCH_CHARS))
 
-    response = response.json()
-    return response['data'][0]['embedding']
+
+@metrics.timed("embedding", provider="ubicloud")
+def generate_ubicloud_embeddings(texts: list) -> list:
+    metrics.add(rows=len(texts))
+    return cached_embeddings(UBICLOUD_VECTOR_MODEL, texts, lambda misses: embed_batches(
+        misses, embed_ubicloud_batch, UBICLOUD_EMBEDDING_BATCH_SIZE, UBICLOUD_EMBEDDING_BATCH_CHARS))
+
+
+@metrics.timed("embedding", provider="ubicloud")
+async def generate_ubicloud_embeddings_async(texts: list) -> list:
+    metrics.add(rows=len(texts))
+    return await cached_embeddings_async(UBICLOUD_VECTOR_MODEL, texts, lambda misses: embed_batches_async(
+        misses, embed_ubicloud_batch_async, UBICLOUD_EMBEDDING_BATCH_SIZE, UBICLOUD_EMBEDDING_BATCH_CHARS))
 
 
+def generate_openai_embedding(text: str) -> list:
+    return generate_openai_embeddings([text])[0]
+
+
+def generate_ubicloud_embedding(text: str) -> list:
+    return generate_ubicloud_embeddings([text])[0]
+
+
+async def generate_ubicloud_embedding_async(text: str) -> list:
+    return (await generate_ubicloud_embeddings_async([text]))[0]
+
+
+@provider_call("completion", "openai", OPENAI_LLM_MODEL, completion_tokens)
 def ask_openai(prompt: str) -> str:
-    chat_completion = client.chat.completions.create(
+    raw = client.chat.completions.with_raw_response.create(
         messages=[
             {
                 "role": "user",
@@ -58,24 +197,165 @@ def ask_openai(prompt: str) -> str:
         ],
         model=OPENAI_LLM_MODEL,
     )
+    rate_limiter.update("openai", OPENAI_LLM_MODEL, raw.headers)
+    chat_completion = raw.parse()
     response = chat_completion.choices[0].message.content
     if not response:
         raise Exception("No response from OpenAI")
+    metrics.add(bytes=text_bytes([prompt, response]),
+                tokens=chat_completion.usage.total_tokens if chat_completion.usage else 0)
     return response.strip()
 
 
+def ubicloud_answer(response) -> str:
+    rate_limiter.update("ubicloud", UBICLOUD_LLM_MODEL, response.headers)
+    if response.status_code != 200:
+        raise ProviderError(response.status_code, response.text, response.headers)
+    response_data = response.json()
+    metrics.add(bytes=len(response.content),
+                tokens=(response_data.get("usage") or {}).get("total_tokens", 0))
+    return response_data["choices"][0]["message"]["content"].strip()
+
+
+@provider_call("completion", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)
 def ask_ubicloud(prompt: str) -> str:
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {UBICLOUD_API_KEY}"
-    }
     data = {
         "model": UBICLOUD_LLM_MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "stream": False
     }
-    response = requests.post(UBICLOUD_LLM_API_URL, headers=headers, json=data)
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
-    response_data = response.json()
-    return response_data["choices"][0]["message"]["content"].strip()
+    return ubicloud_answer(ubicloud_client.post(
+        "completion", UBICLOUD_LLM_API_URL, headers=ubicloud_headers(), json=data))
+
+
+@provider_call("completion_stream", "openai", OPENAI_LLM_MODEL, completion_tokens)
+def ask_openai_stream(prompt: str):
+    """
+    Yields the answer to `prompt` in pieces as OpenAI generates it.
+    """
+    raw = client.chat.completions.with_raw_response.create(
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        model=OPENAI_LLM_MODEL,
+        stream=True,
+    )
+    rate_limiter.update("openai", OPENAI_LLM_MODEL, raw.headers)
+    stream = raw.parse()
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def sse_delta(line):
+    """
+    Returns the answer piece in one line of a streaming completion's
+    server-sent events: None for comments and the blank lines between events,
+    and False once the stream is done.
+    """
+    if not line or not line.startswith("data:"):
+        return None
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return False
+    choices = json.loads(payload).get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content")
+
+
+@provider_call("completion_stream", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)
+def ask_ubicloud_stream(prompt: str):
+    """
+    Yields the answer to `prompt` in pieces, read from the server-sent events
+    of a streaming completion.
+    """
+    data = {
+        "model": UBICLOUD_LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True
+    }
+    with ubicloud_client.post_stream("completion_stream", UBICLOUD_LLM_API_URL,
+                                     headers=ubicloud_headers(), json=data) as response:
+        rate_limiter.update("ubicloud", UBICLOUD_LLM_MODEL, response.headers)
+        if response.status_code != 200:
+            raise ProviderError(response.status_code, response.text, response.headers)
+        response.encoding = "utf-8"
+        # chunk_size=None hands over data as it arrives instead of buffering
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            delta = sse_delta(line)
+            if delta is False:
+                break
+            if delta:
+                yield delta
+
+
+@provider_call("completion_stream", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)
+async def ask_ubicloud_stream_async(prompt: str):
+    data = {
+        "model": UBICLOUD_LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True
+    }
+    async with ubicloud_client.async_post_stream("completion_stream", UBICLOUD_LLM_API_URL,
+                                                 headers=ubicloud_headers(), json=data) as response:
+        rate_limiter.update("ubicloud", UBICLOUD_LLM_MODEL, response.headers)
+        if response.status_code != 200:
+            await response.aread()
+            raise ProviderError(response.status_code, response.text, response.headers)
+        async for line in response.aiter_lines():
+            delta = sse_delta(line)
+            if delta is False:
+                break
+            if delta:
+                yield delta
+
+
+@provider_call("completion_stream", "openai", OPENAI_LLM_MODEL, completion_tokens)
+async def ask_openai_stream_async(prompt: str):
+    raw = await async_client.chat.completions.with_raw_response.create(
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        model=OPENAI_LLM_MODEL,
+        stream=True,
+    )
+    rate_limiter.update("openai", OPENAI_LLM_MODEL, raw.headers)
+    stream = raw.parse()
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+if LLM_BACKEND == "fake":
+    import fake_provider
+    # Distinct model names keep fake answers and vectors out of the caches
+    # that live runs read
+    OPENAI_LLM_MODEL = "fake-" + OPENAI_LLM_MODEL
+    OPENAI_VECTOR_MODEL = "fake-" + OPENAI_VECTOR_MODEL
+    UBICLOUD_LLM_MODEL = "fake-" + UBICLOUD_LLM_MODEL
+    UBICLOUD_VECTOR_MODEL = "fake-" + UBICLOUD_VECTOR_MODEL
+    embed_openai_batch = provider_call("embedding_request", "openai", OPENAI_VECTOR_MODEL, embedding_tokens)(
+        fake_provider.embedder(OPENAI_VECTOR_DIMENSIONS))
+    embed_ubicloud_batch = provider_call("embedding_request", "ubicloud", UBICLOUD_VECTOR_MODEL, embedding_tokens)(
+        fake_provider.embedder(UBICLOUD_VECTOR_DIMENSIONS))
+    embed_ubicloud_batch_async = provider_call("embedding_request", "ubicloud", UBICLOUD_VECTOR_MODEL, embedding_tokens)(
+        fake_provider.async_embedder(UBICLOUD_VECTOR_DIMENSIONS))
+    ask_openai = provider_call("completion", "openai", OPENAI_LLM_MODEL, completion_tokens)(
+        fake_provider.asker("openai"))
+    ask_ubicloud = provider_call("completion", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)(
+        fake_provider.asker("ubicloud"))
+    ask_openai_stream = provider_call("completion_stream", "openai", OPENAI_LLM_MODEL, completion_tokens)(
+        fake_provider.stream_asker("openai"))
+    ask_ubicloud_stream = provider_call("completion_stream", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)(
+        fake_provider.stream_asker("ubicloud"))
+    ask_openai_stream_async = provider_call("completion_stream", "openai", OPENAI_LLM_MODEL, completion_tokens)(
+        fake_provider.async_stream_asker("openai"))
+    ask_ubicloud_stream_async = provider_call("completion_stream", "ubicloud", UBICLOUD_LLM_MODEL, completion_tokens)(
+        fake_provider.async_stream_asker("ubicloud"))
+elif LLM_BACKEND != "live":
+    raise ValueError(f"Unknown LLM_BACKEND {LLM_BACKEND!r}, expected live or fake")
@@ -1,23 +1,65 @@
 import os
-import re
-import sys
-import psycopg2
-from pgconf_utils import ask_openai, ask_ubicloud, OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW
+import hashlib
+import argparse
+import subprocess
+import threading
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pgconf_utils import ask_openai, ask_ubicloud, OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW, OPENAI_LLM_MODEL, UBICLOUD_LLM_MODEL
 from dotenv import load_dotenv
 from backfill_embeddings import backfill
+from chunker import chunk_text, PROMPT_RESERVE_TOKENS
+from vector_writer import insert_rows, to_vector
+from completion_cache import cached_completion, completion_cache_summary
+from ubicloud_client import latency_summary
+from db_pool import get_cursor
 load_dotenv()
 
 FILE_PROMPT = """Here is some code. Summarize what the code does."""
 FILE_SUMMARIES_PROMPT = """Here are multiple summaries of sections of a file. Summarize what the code does."""
+CHUNK_PROMPT = """Here is a section of a file. Summarize what this section of the code does."""
 FOLDER_PROMPT = """Here are the summaries of the files and subfolders in this folder. Summarize what the folder does."""
 FOLDER_SUMMARIES_PROMPT = """Here are multiple summaries of the files and subfolders in this folder. Summarize what the folder does."""
 REPO_PROMPT = """Here are the summaries of the folders in this repository. Summarize what the repository does."""
 COMMIT_PROMPT = """Here is a commit, including the commit message, and the changes made in the commit. Summarize the commit."""
-
-# Database
-DATABASE_URL = os.getenv("DATABASE_URL")
-conn = psycopg2.connect(DATABASE_URL)
-cur = conn.cursor()
+# Names under which cached completions are stored, to invalidate them per template
+PROMPT_TEMPLATES = {
+    "FILE_PROMPT": FILE_PROMPT,
+    "FILE_SUMMARIES_PROMPT": FILE_SUMMARIES_PROMPT,
+    "CHUNK_PROMPT": CHUNK_PROMPT,
+    "FOLDER_PROMPT": FOLDER_PROMPT,
+    "FOLDER_SUMMARIES_PROMPT": FOLDER_SUMMARIES_PROMPT,
+    "REPO_PROMPT": REPO_PROMPT,
+    "COMMIT_PROMPT": COMMIT_PROMPT,
+}
+
+# Tokens per file_chunks row, the unit retrieval can return instead of a
+# whole file
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "1000"))
+
+# Concurrency: files and folders summarized at once, and LLM calls in flight
+# per provider across all of them
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+LLM_CONCURRENCY = {
+    "openai": int(os.getenv("OPENAI_CONCURRENCY", "8")),
+    "ubicloud": int(os.getenv("UBICLOUD_CONCURRENCY", "4")),
+}
+llm_slots = {provider: threading.BoundedSemaphore(limit)
+             for provider, limit in LLM_CONCURRENCY.items()}
+# Tasks on llm_executor only make LLM calls. Tasks on provider_executor may
+# wait on llm_executor, and scheduler tasks may wait on both, so no pool ever
+# waits on itself.
+llm_executor = ThreadPoolExecutor(max_workers=sum(LLM_CONCURRENCY.values()))
+provider_executor = ThreadPoolExecutor(max_workers=2 * INGEST_WORKERS)
+
+FOLDER_COLUMNS = ["name", "repo", "llm_openai", "llm_ubicloud",
+                  "vector_openai", "vector_ubicloud"]
+FILE_COLUMNS = ["name", "folder", "repo", "code", "llm_openai", "llm_ubicloud",
+                "vector_openai", "vector_ubicloud", "content_hash"]
+CHUNK_COLUMNS = ["repo", "folder", "name", "chunk", "start_line", "end_line", "code",
+                 "llm_openai", "llm_ubicloud", "vector_openai", "vector_ubicloud"]
+COMMIT_COLUMNS = ["repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud",
+                  "vector_openai", "vector_ubicloud"]
 
 
 def is_acceptable_file(file_name):
@@ -38,176 +80,325 @@ def is_acceptable_folder(folder_name):
     return not any(part in EXCLUDED_DIRS for part in path_parts)
 
 
-def insert_repo(repo_name):
-    INSERT_REPO = f"""INSERT INTO repos ("name") VALUES (%s) ON CONFLICT DO NOTHING;"""
-    cur.execute(INSERT_REPO, (repo_name,))
-    conn.commit()
+def cached_ask(provider):
+    """
+    Returns an ask function for `provider` that replays completions stored by
+    previous ingestion runs.
+    """
+    model = OPENAI_LLM_MODEL if provider == "openai" else UBICLOUD_LLM_MODEL
+
+    def ask_limited(prompt):
+        ask = ask_openai if provider == "openai" else ask_ubicloud
+        with llm_slots[provider]:
+            return ask(prompt)
+
+    def ask_with_cache(prompt):
+        template = next((name for name, template in PROMPT_TEMPLATES.items()
+                         if prompt.startswith(template)), None)
+        return cached_completion(provider, model, template, prompt, ask_limited)
+    return ask_with_cache
+
+
+ask_openai_cached = cached_ask("openai")
+ask_ubicloud_cached = cached_ask("ubicloud")
 
 
-def insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud):
-    INSERT_FOLDER = """
-        INSERT INTO folders ("name", "repo", "llm_openai", "llm_ubicloud")
-        VALUES (%s, %s, %s, %s) ON CONFLICT ("name", "repo") DO NOTHING;
+def ask_many(ask, prompts):
     """
-    cur.execute(INSERT_FOLDER, (folder_name, repo_name,
-                llm_openai.strip(), llm_ubicloud.strip()))
-    conn.commit()
+    Asks all `prompts` concurrently and returns the answers in order.
+    """
+    return list(llm_executor.map(ask, prompts))
 
 
-def insert_file(file_name, folder_name, repo_name, file_content, llm_openai, llm_ubicloud):
-    INSERT_FILE = """
-        INSERT INTO files ("name", "folder", "repo", "code", "llm_openai", "llm_ubicloud")
-        VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT ("name", "folder", "repo") DO NOTHING;
+def run_both(openai_fn, ubicloud_fn):
+    """
+    Runs the two providers' summarization of the same input concurrently.
     """
-    cur.execute(INSERT_FILE, (file_name, folder_name, repo_name,
-                file_content, llm_openai.strip(), llm_ubicloud.strip()))
-    conn.commit()
+    ubicloud = provider_executor.submit(ubicloud_fn)
+    return openai_fn(), ubicloud.result()
 
 
-def insert_commit(repo_name, commit_id, author, date, changes, message, llm_openai, llm_ubicloud):
-    INSERT_COMMIT = """
-        INSERT INTO commits ("repo", "id", "author", "date", "changes", "message", "llm_openai", "llm_ubicloud")
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT ("repo", "id") DO NOTHING;
+def insert_repo(repo_name, indexed_commit=None):
+    INSERT_REPO = """
+        INSERT INTO repos ("name", "indexed_commit", "indexed_at") VALUES (%s, %s, now())
+        ON CONFLICT ("name") DO UPDATE SET "indexed_commit" = EXCLUDED."indexed_commit", "indexed_at" = EXCLUDED."indexed_at";
     """
-    cur.execute(INSERT_COMMIT, (repo_name, commit_id, author, date,
-                changes, message, llm_openai.strip(), llm_ubicloud.strip()))
-    conn.commit()
+    with get_cursor() as cur:
+        cur.execute(INSERT_REPO, (repo_name, indexed_commit))
 
 
-def chunk_file(file_content, context_window):
+def create_partitions(repo_name):
     """
-    Splits the file content into chunks, ensuring that each chunk ends at a function boundary.
-    Specifically, it looks for `}` at the beginning of a line as a natural break point.
+    Creates the repo's partitions of folders, files, commits and file_chunks,
+    with their indexes, if it has none yet.
     """
-    chunks = []
-    current_chunk = []
-    current_size = 0
+    with get_cursor() as cur:
+        cur.execute("SELECT create_repo_partitions(%s)", (repo_name,))
+
+
+def drop_repo(repo_name):
+    """
+    Removes everything indexed for a repo by dropping its partitions.
+    """
+    with get_cursor() as cur:
+        cur.execute("SELECT drop_repo_partitions(%s)", (repo_name,))
+
+
+def insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud, vector_openai=None, vector_ubicloud=None):
+    with get_cursor() as cur:
+        insert_rows(cur, "folders", FOLDER_COLUMNS,
+                    [(folder_name, repo_name, llm_openai.strip(), llm_ubicloud.strip(),
+                      to_vector(vector_openai), to_vector(vector_ubicloud))],
+                    ["name", "repo"])
+
+
+def insert_file(file_name, folder_name, repo_name, file_content, llm_openai, llm_ubicloud, vector_openai=None, vector_ubicloud=None, content_hash=None):
+    with get_cursor() as cur:
+        insert_rows(cur, "files", FILE_COLUMNS,
+                    [(file_name, folder_name, repo_name, file_content, llm_openai.strip(), llm_ubicloud.strip(),
+                      to_vector(vector_openai), to_vector(vector_ubicloud), content_hash)],
+                    ["name", "folder", "repo"])
+
+
+def insert_chunks(file_name, folder_name, repo_name, chunks, summaries):
+    """
+    Inserts a file's `chunks`, (start_line, end_line, code) triples, with
+    their (llm_openai, llm_ubicloud) `summaries`.
+    """
+    with get_cursor() as cur:
+        insert_rows(cur, "file_chunks", CHUNK_COLUMNS,
+                    [(repo_name, folder_name, file_name, i, start_line, end_line, code,
+                      llm_openai.strip(), llm_ubicloud.strip(), None, None)
+                     for i, ((start_line, end_line, code), (llm_openai, llm_ubicloud))
+                     in enumerate(zip(chunks, summaries))],
+                    ["repo", "folder", "name", "chunk"])
+
+
+def line_ranges(chunks):
+    """
+    Pairs chunks made by chunk_text with their first and last line numbers.
+    """
+    ranges = []
+    start = 1
+    for chunk in chunks:
+        end = start + chunk.count("\n")
+        ranges.append((start, end, chunk))
+        start = end + 1
+    return ranges
+
+
+def insert_commit(repo_name, commit_id, author, date, changes, message, llm_openai, llm_ubicloud, vector_openai=None, vector_ubicloud=None):
+    with get_cursor() as cur:
+        insert_rows(cur, "commits", COMMIT_COLUMNS,
+                    [(repo_name, commit_id, author, date, changes, message, llm_openai.strip(), llm_ubicloud.strip(),
+                      to_vector(vector_openai), to_vector(vector_ubicloud))],
+                    ["repo", "id"])
 
-    # Split the content into lines for easier processing
-    lines = file_content.splitlines()
 
-    for line in lines:
-        if len(line) > context_window:
-            line = line[:(context_window)]
-        current_chunk.append(line)
-        current_size += len(line)
+def summarize_chunks(file_name, chunks, ask):
+    return ask_many(ask, [
+        f"{CHUNK_PROMPT}\n\nFile: {file_name} (lines {start}-{end})\n\n{code}"
+        for start, end, code in chunks])
 
-        # If we've reached a size limit
-        if (
-            (current_size >= context_window and (
-                re.match(r'^\}', line) or re.match(r'^\};', line) or re.match(r'^\];$', line)))
-            or (current_size >= 2 * context_window and (re.match(r'^\s{2}\}', line)))
-            or (current_size >= 3 * context_window)
-        ):
-            chunks.append("\n".join(current_chunk))
-            current_chunk = []
-            current_size = 0
 
-    # Add the remaining chunk if any content is left
-    if current_chunk:
-        chunks.append("\n".join(current_chunk))
+# Files with a summary and code but no chunks, i.e. indexed before file_chunks
+# existed
+UNCHUNKED_FILES = """
+    "code" <> '' AND NOT EXISTS (
+        SELECT 1 FROM file_chunks c
+        WHERE c."repo" = f."repo" AND c."folder" = f."folder" AND c."name" = f."name")"""
 
-    return chunks
 
+def unchunked_files(repo_name):
+    with get_cursor() as cur:
+        cur.execute(f"""SELECT count(*) FROM files f WHERE "repo" = %s AND {UNCHUNKED_FILES}""", (repo_name,))
+        return cur.fetchone()[0]
 
+
+def chunk_stored_file(file_name, folder_name, repo_name, llm_openai, llm_ubicloud):
+    """
+    Chunks a file indexed before file_chunks existed from its stored code, so
+    the chunks match the summary it already has.
+    """
+    print("Chunking file:", os.path.join(folder_name, file_name))
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "code" FROM files WHERE "name" = %s AND "folder" = %s AND "repo" = %s""", (file_name, folder_name, repo_name))
+        code, = cur.fetchone()
+    chunks = line_ranges(chunk_text(code, [CHUNK_TOKENS], file_name)[0])
+    if len(chunks) == 1:
+        summaries = [(llm_openai, llm_ubicloud)]
+    else:
+        summaries = list(zip(*run_both(
+            lambda: summarize_chunks(file_name, chunks, ask_openai_cached),
+            lambda: summarize_chunks(file_name, chunks, ask_ubicloud_cached))))
+    insert_chunks(file_name, folder_name, repo_name, chunks, summaries)
+
+
+@metrics.timed("summarize_file")
 def process_file(file_path, folder_name, repo_name):
     file_name = os.path.basename(file_path)
 
     # If file already has a summary, skip processing and just return it
-    cur.execute(
-        """SELECT "llm_openai", "llm_ubicloud" FROM files WHERE "name" = %s AND "folder" = %s AND "repo" = %s""", (file_name, folder_name, repo_name))
-    row = cur.fetchone()
+    with get_cursor() as cur:
+        cur.execute(
+            f"""SELECT "llm_openai", "llm_ubicloud", {UNCHUNKED_FILES} FROM files f WHERE "name" = %s AND "folder" = %s AND "repo" = %s""", (file_name, folder_name, repo_name))
+        row = cur.fetchone()
     if row:
-        return row
+        llm_openai, llm_ubicloud, unchunked = row
+        if unchunked:
+            chunk_stored_file(file_name, folder_name, repo_name, llm_openai, llm_ubicloud)
+        return llm_openai, llm_ubicloud
 
     # Summarize each chunk and combine summaries
     def get_description(chunks, ask):
         if len(chunks) == 1:
             return ask(FILE_PROMPT + "\n\nFile: " + file_name + "\n\n" + chunks[0])
         else:
-            descriptions = []
-            for chunk in chunks:
-                descriptions.append(
-                    ask(FILE_PROMPT + "\n\nFile: " + file_name + "\n\n" + chunk))
+            descriptions = ask_many(
+                ask, [FILE_PROMPT + "\n\nFile: " + file_name + "\n\n" + chunk for chunk in chunks])
             return ask(FILE_SUMMARIES_PROMPT + "\n\nFile: " + file_name + "\n\n" + "\n".join(descriptions[:10]))
 
+    # A file that is a single chunk is described by its own summary
+    def describe(chunks, ask):
+        description = get_description(chunks, ask)
+        if len(chunks_retrieval) == 1:
+            return description, [description]
+        return description, summarize_chunks(file_name, chunks_retrieval, ask)
+
     print("File:", file_path)
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        file_content = f.read()
+    with open(file_path, 'rb') as f:
+        file_bytes = f.read()
+        metrics.add(bytes=len(file_bytes))
+        file_content = file_bytes.decode('utf-8', errors='ignore')
 
-        chunks_openai = chunk_file(file_content, OPENAI_CONTEXT_WINDOW)
-        chunks_ubicloud = chunk_file(file_content, UBICLOUD_CONTEXT_WINDOW)
+        chunks_openai, chunks_ubicloud, chunks_retrieval = chunk_text(
+            file_content, [OPENAI_CONTEXT_WINDOW - PROMPT_RESERVE_TOKENS,
+                           UBICLOUD_CONTEXT_WINDOW - PROMPT_RESERVE_TOKENS,
+                           CHUNK_TOKENS], file_name)
+        chunks_retrieval = line_ranges(chunks_retrieval)
 
-        llm_openai = get_description(chunks_openai, ask_openai)
-        llm_ubicloud = get_description(chunks_ubicloud, ask_ubicloud)
+        (llm_openai, chunk_openai), (llm_ubicloud, chunk_ubicloud) = run_both(
+            lambda: describe(chunks_openai, ask_openai_cached),
+            lambda: describe(chunks_ubicloud, ask_ubicloud_cached))
 
         # Insert the file and its components into the database
         insert_file(file_name, folder_name, repo_name,
-                    file_content, llm_openai, llm_ubicloud)
+                    file_content, llm_openai, llm_ubicloud, content_hash=git_blob_id(file_bytes))
+        insert_chunks(file_name, folder_name, repo_name, chunks_retrieval,
+                      list(zip(chunk_openai, chunk_ubicloud)))
 
         return llm_openai, llm_ubicloud
 
 
-def process_folder(folder_path, repo_path, repo_name):
-    if not is_acceptable_folder(folder_path):
-        return
+@metrics.timed("summarize_folder")
+def process_folder(folder_path, repo_path, repo_name, summaries):
+    """
+    Summarizes a folder from `summaries`, the (llm_openai, llm_ubicloud) pairs
+    of its files and subfolders, and returns its own pair.
+    """
     print("Folder:", folder_path)
 
-    # If folder already has a summary, skip processing and just return
-    cur.execute(
-        """SELECT 1 FROM folders WHERE "name" = %s AND "repo" = %s""", (folder_path, repo_name))
-    row = cur.fetchone()
-    if row:
-        return
-
     # Full relative folder path
     folder_name = os.path.relpath(folder_path, repo_path)
-    llm_openai_list = []
-    llm_ubicloud_list = []
-
-    # Process each file in the folder
-    for item in os.listdir(folder_path):
-        item_path = os.path.join(folder_path, item)
-        if os.path.isfile(item_path) and is_acceptable_file(item):
-            llm_openai, llm_ubicloud = process_file(
-                item_path, folder_name, repo_name)
-            if llm_openai:
-                llm_openai_list.append(llm_openai)
-            if llm_ubicloud:
-                llm_ubicloud_list.append(llm_ubicloud)
-        elif os.path.isdir(item_path) and is_acceptable_folder(item_path):
-            # Retrieve the summary of the subfolder from the database
-            subfolder_name = os.path.relpath(item_path, repo_path)
-            cur.execute(
-                """SELECT "llm_openai", "llm_ubicloud" FROM folders WHERE "name" = %s AND "repo" = %s""", (subfolder_name, repo_name))
-            subfolder_row = cur.fetchone()
-            if subfolder_row and subfolder_row[0]:
-                llm_openai = subfolder_row[0][0]
-                llm_ubicloud = subfolder_row[0][1]
-                if llm_openai:
-                    llm_openai_list.append(llm_openai)
-                if llm_ubicloud:
-                    llm_ubicloud_list.append(llm_ubicloud)
+
+    # If folder already has a summary, skip processing and just return it
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "llm_openai", "llm_ubicloud" FROM folders WHERE "name" = %s AND "repo" = %s""", (folder_name, repo_name))
+        row = cur.fetchone()
+    if row:
+        return row
+
+    llm_openai_list = [llm_openai for llm_openai, _ in summaries if llm_openai]
+    llm_ubicloud_list = [llm_ubicloud for _,
+                         llm_ubicloud in summaries if llm_ubicloud]
 
     def get_description(descriptions, ask, context_window):
         max_descriptions = int(context_window / 450)
         if len(descriptions) < max_descriptions:
             return ask(FOLDER_PROMPT + "\n\n" + "\n".join(descriptions))
         else:
-            combined_descriptions = []
-            for i in range(0, min(len(descriptions),  max_descriptions * max_descriptions), max_descriptions):
-                combined_description = ask(
-                    FOLDER_PROMPT + "\n\n" + "\n".join(descriptions[i:i+max_descriptions]))
-                combined_descriptions.append(combined_description)
+            combined_descriptions = ask_many(ask, [
+                FOLDER_PROMPT + "\n\n" + "\n".join(descriptions[i:i+max_descriptions])
+                for i in range(0, min(len(descriptions),  max_descriptions * max_descriptions), max_descriptions)])
             return ask(FOLDER_SUMMARIES_PROMPT + "\n\n" + "\n".join(combined_descriptions))
 
-    llm_openai = get_description(
-        llm_openai_list, ask_openai, OPENAI_CONTEXT_WINDOW)
-    llm_ubicloud = get_description(
-        llm_ubicloud_list, ask_ubicloud, UBICLOUD_CONTEXT_WINDOW)
+    llm_openai, llm_ubicloud = run_both(
+        lambda: get_description(
+            llm_openai_list, ask_openai_cached, OPENAI_CONTEXT_WINDOW),
+        lambda: get_description(llm_ubicloud_list, ask_ubicloud_cached, UBICLOUD_CONTEXT_WINDOW))
 
     insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud)
+    return llm_openai, llm_ubicloud
+
+
+def walk_tree(repo_path):
+    """
+    Maps every acceptable folder under `repo_path` to its acceptable files
+    (names) and subfolders (paths).
+    """
+    children = {}
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = sorted(d for d in dirs
+                         if is_acceptable_folder(os.path.join(root, d)))
+        if not is_acceptable_folder(root):
+            continue
+        children[root] = ([f for f in sorted(files) if is_acceptable_file(f) and os.path.isfile(os.path.join(root, f))],
+                          [os.path.join(root, d) for d in dirs])
+    return children
+
+
+@metrics.timed("process_tree")
+def process_tree(repo_path, repo_name, workers=INGEST_WORKERS):
+    """
+    Summarizes every acceptable file and folder under `repo_path`, bottom-up.
+    Files run concurrently, and each folder is scheduled as soon as all of its
+    files and subfolders are summarized, so sibling subtrees never wait on
+    each other.
+    """
+    children = walk_tree(repo_path)
+
+    # Summaries collected per folder, keyed by item so prompts stay in a
+    # stable order across runs (and hit the completion cache)
+    summaries = {folder: {} for folder in children}
+    pending = {folder: len(files) + len(subfolders)
+               for folder, (files, subfolders) in children.items()}
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_folder(folder):
+            items = summaries[folder]
+            future = executor.submit(process_folder, folder, repo_path, repo_name,
+                                     [items[name] for name in sorted(items)])
+            in_flight[future] = (folder, None)
+
+        for folder, (files, _) in children.items():
+            folder_name = os.path.relpath(folder, repo_path)
+            for file in files:
+                future = executor.submit(process_file, os.path.join(folder, file),
+                                         folder_name, repo_name)
+                in_flight[future] = (folder, file)
+            if pending[folder] == 0:
+                submit_folder(folder)
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, file = in_flight.pop(future)
+                if file is not None:
+                    # A file finished: record it in its folder
+                    parent, item = folder, file
+                else:
+                    # A folder finished: record it in its parent folder
+                    parent, item = os.path.dirname(folder), os.path.basename(folder)
+                    if folder == repo_path or parent not in pending:
+                        future.result()
+                        continue
+                summaries[parent][item] = future.result()
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    submit_folder(parent)
 
 
 def extract_files_changed(diff_content):
@@ -226,91 +417,325 @@ def extract_files_changed(diff_content):
     return list(files_changed)
 
 
-def process_commits(repo_path, repo_name):
-    # Extract commit data using git log
-    os.system(
-        f"git -C {repo_path} log -p -n 1000 --pretty=format:'COMMIT_HASH:%H|AUTHOR_NAME:%an|AUTHOR_EMAIL:%ae|DATE:%ad|TITLE:%s|MESSAGE:%b' --date=iso > commit_data.txt"
-    )
+# git log pretty format: a record separator before each commit, unit
+# separators between its fields, and a group separator where the body ends
+COMMIT_LOG_FORMAT = "%x1e%H%x1f%an%x1f%ae%x1f%ad%x1f%s%x1f%b%x1d"
+COMMIT_LOG_COUNT = 1000
+# Summarized commits inserted per statement
+COMMIT_INSERT_BATCH = 50
 
-    # Read commit data from file
-    with open('commit_data.txt', 'r') as file:
-        lines = file.readlines()
 
+def read_commits(repo_path, max_count=COMMIT_LOG_COUNT, revision_range=None, skip_ids=()):
+    """
+    Streams `git log -p` through a pipe and yields one dict per commit, newest
+    first. Only the commit being parsed is held in memory, and the diff of a
+    commit whose id is in `skip_ids` is read past without being kept.
+    """
+    command = ["git", "-C", repo_path, "log", "-p", "--no-color", "--no-ext-diff",
+               "--date=iso", f"--pretty=format:{COMMIT_LOG_FORMAT}"]
+    if max_count is not None:
+        command.append(f"--max-count={max_count}")
+    if revision_range:
+        command.append(revision_range)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, encoding="utf-8", errors="replace")
+
+    commit = None
+    header = []
+    try:
+        for line in process.stdout:
+            if line.startswith("\x1e"):
+                if commit is not None:
+                    yield commit
+                commit = None
+                header = [line[1:]]
+            elif commit is None and header:
+                header.append(line)
+            elif commit is not None and commit["changes"] is not None:
+                commit["changes"].append(line)
+            else:
+                continue
+
+            if commit is None and "\x1d" in header[-1]:
+                fields, rest = "".join(header).split("\x1d", 1)
+                commit_id, author_name, author_email, date, title, message = fields.split("\x1f")
+                header = []
+                # A diff that follows on the same line as the end of the body
+                changes = None if commit_id in skip_ids else [rest.lstrip("\n")]
+                commit = {"id": commit_id, "author": f"{author_name} <{author_email}>",
+                          "date": date, "title": title, "message": message.strip(),
+                          "changes": changes}
+        if commit is not None:
+            yield commit
+        # A bad range or path would otherwise read as a repo without commits
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"git log failed in {repo_path}: {error.strip()}")
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+        process.stderr.close()
+
+
+@metrics.timed("summarize_commit")
+def summarize_commit(commit):
+    """
+    Returns the row to insert into commits for a parsed commit.
+    """
+    changes = "".join(commit["changes"]).strip("\n")
+    metrics.add(bytes=len(changes.encode("utf-8")))
+    author = commit["author"]
+    if len(changes) < min(OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW):
+        input = f"{commit['title']}\n{commit['message']}\nChanges: {changes}\nAuthor: {author}>\nDate: {commit['date']}"
+    else:
+        files_changed = extract_files_changed(changes)
+        input = f"{commit['title']}\n{commit['message']}\nFiles changed: {', '.join(files_changed)}\nAuthor: {author}>\nDate: {commit['date']}"
+    llm_openai, llm_ubicloud = run_both(
+        lambda: ask_openai_cached(COMMIT_PROMPT + "\n\n" + input),
+        lambda: ask_ubicloud_cached(COMMIT_PROMPT + "\n\n" + input))
+    return (commit["repo"], commit["id"], author, commit["date"], changes, commit["message"],
+            llm_openai.strip(), llm_ubicloud.strip(), None, None)
+
+
+@metrics.timed("process_commits")
+def process_commits(repo_path, repo_name, max_count=COMMIT_LOG_COUNT, revision_range=None, workers=INGEST_WORKERS):
+    """
+    Summarizes the commits git log returns that are not in the commits table
+    yet, `workers` at a time, and inserts them COMMIT_INSERT_BATCH rows at a
+    time. At most twice `workers` parsed commits are held at once.
+    """
     # Previously processed commit IDs
-    cur.execute("""SELECT "id" FROM commits WHERE "repo" = %s""", (repo_name,))
-    processed_commit_ids = {row[0] for row in cur.fetchall()}
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "id" FROM commits WHERE "repo" = %s""", (repo_name,))
+        processed_commit_ids = {row[0] for row in cur.fetchall()}
 
-    # Variables to store commit data
-    commit_id = author_name = author_email = commit_date = title = message = ""
-    changes_list = []
-    in_diff_section = False
+    rows = []
     commit_count = 0
 
-    def maybe_save_commit():
-        nonlocal commit_count
-        if commit_id in processed_commit_ids:
+    def flush():
+        nonlocal rows, commit_count
+        if not rows:
             return
-        if commit_id:
-            changes = "\n".join(changes_list)
-            author = f"{author_name} <{author_email}>"
-            if len(changes) < min(OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW):
-                input = f"{title}\n{message}\nChanges: {changes}\nAuthor: {author}>\nDate: {commit_date}"
-            else:
-                files_changed = extract_files_changed(changes)
-                input = f"{title}\n{message}\Files changed: {', '.join(files_changed)}\nAuthor: {author}>\nDate: {commit_date}"
-            llm_ubicloud = ask_ubicloud(COMMIT_PROMPT + "\n\n" + input)
-            llm_openai = ask_openai(COMMIT_PROMPT + "\n\n" + input)
-            insert_commit(repo_name, commit_id, author, commit_date,
-                          changes, message, llm_openai, llm_ubicloud)
-            commit_count += 1
-            if commit_count % 10 == 0:
-                print(f"Processed {commit_count} commits...")
-
-    # Process each line to extract and insert commit data
-    for line in lines:
-        line = line.strip()
-        print(line)
-
-        if line.startswith("COMMIT_HASH:"):
-            maybe_save_commit()
-
-            # Start reading a new commit
-            commit_id = line.split("COMMIT_HASH:")[1].strip()
-            in_diff_section = False
-            changes_list = []
-
-        elif line.startswith("AUTHOR_NAME:"):
-            author_name = line.split("AUTHOR_NAME:")[1].strip()
-        elif line.startswith("AUTHOR_EMAIL:"):
-            author_email = line.split("AUTHOR_EMAIL:")[1].strip()
-        elif line.startswith("DATE:"):
-            commit_date = line.split("DATE:")[1].strip()
-        elif line.startswith("TITLE:"):
-            title = line.split("TITLE:")[1].strip()
-        elif line.startswith("MESSAGE:"):
-            message = line.split("MESSAGE:")[1].strip()
-        elif line == "" and commit_id:
-            # Empty line indicates the start of the diff section
-            in_diff_section = True
-        elif in_diff_section:
-            # Accumulate the diff (changes)
-            changes_list.append(line)
-
-    # Insert the last commit's data
-    maybe_save_commit()
-
-    # Delete the temporary commit data file
-    if os.path.exists('commit_data.txt'):
-        os.remove('commit_data.txt')
-
-
-def main(repo_name):
+        with get_cursor() as cur:
+            insert_rows(cur, "commits", COMMIT_COLUMNS, rows, ["repo", "id"])
+        commit_count += len(rows)
+        rows = []
+        print(f"Processed {commit_count} commits...")
+
+    def collect(done):
+        for future in done:
+            rows.append(future.result())
+        if len(rows) >= COMMIT_INSERT_BATCH:
+            flush()
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for commit in read_commits(repo_path, max_count, revision_range, processed_commit_ids):
+            if commit["id"] in processed_commit_ids:
+                continue
+            commit["repo"] = repo_name
+            in_flight.add(executor.submit(summarize_commit, commit))
+            if len(in_flight) >= 2 * workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(in_flight)
+    flush()
+    print(f"Processed {commit_count} commits.")
+
+
+def git_blob_id(data: bytes) -> str:
+    """
+    The id git gives a blob with these contents, so stored hashes can be
+    compared with `git ls-tree`/`git hash-object` output.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def git(repo_path, *args):
+    result = subprocess.run(["git", "-C", repo_path, *args],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+
+def git_head(repo_path):
+    head = git(repo_path, "rev-parse", "HEAD")
+    return head.strip() if head else None
+
+
+def changed_paths_since(repo_path, commit):
+    """
+    Returns the (changed, deleted) relative paths between `commit` and the
+    working tree, including untracked files, or None if git cannot tell.
+    """
+    diff = git(repo_path, "diff", "--name-status", "--no-renames", "-z", commit)
+    untracked = git(repo_path, "ls-files", "--others", "--exclude-standard", "-z")
+    if diff is None or untracked is None:
+        return None
+    changed, deleted = set(), set()
+    fields = diff.split("\0")
+    for status, path in zip(fields[0::2], fields[1::2]):
+        (deleted if status == "D" else changed).add(path)
+    changed.update(path for path in untracked.split("\0") if path)
+    return changed, deleted
+
+
+def changed_paths_by_hash(repo_path, stored, found):
+    """
+    Compares every acceptable file on disk with its stored blob id (or its
+    stored code, for rows indexed before hashes were stored) and returns the
+    (changed, deleted) relative paths. See hash_matches for `found`.
+    """
+    indexed = set()
+    for folder, (files, _) in walk_tree(repo_path).items():
+        indexed.update(os.path.relpath(os.path.join(folder, file), repo_path)
+                       for file in files)
+    return {path for path in indexed if not hash_matches(repo_path, path, stored, found)}, set(stored) - indexed
+
+
+def stored_hashes(repo_name):
+    """
+    Maps the relative path of every indexed file to its (blob id, code). The
+    code is only read for rows indexed before hashes were stored, whose blob
+    id is NULL.
+    """
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "folder", "name", "content_hash", CASE WHEN "content_hash" IS NULL THEN "code" END FROM files WHERE "repo" = %s""", (repo_name,))
+        return {os.path.normpath(os.path.join(folder, name)): (content_hash, code)
+                for folder, name, content_hash, code in cur.fetchall()}
+
+
+def hash_matches(repo_path, path, stored, found):
+    """
+    Returns whether `path` is indexed as it is on disk. Rows without a blob
+    id hold the code as read in text mode, with \\r\\n turned into \\n, and
+    are compared that way; the blob ids of those that match are added to
+    `found`, to be written back with store_hashes.
+    """
+    if path not in stored:
+        return False
+    content_hash, code = stored[path]
+    with open(os.path.join(repo_path, path), 'rb') as f:
+        data = f.read()
+    if content_hash is not None:
+        return content_hash == git_blob_id(data)
+    if code is None or code.encode("utf-8") != data.replace(b"\r\n", b"\n").replace(b"\r", b"\n"):
+        return False
+    found[path] = git_blob_id(data)
+    return True
+
+
+def store_hashes(repo_name, found):
+    """
+    Records the blob ids of unchanged files indexed before hashes were
+    stored, so later updates compare them exactly.
+    """
+    if not found:
+        return
+    paths = [(os.path.dirname(path) or ".", os.path.basename(path)) for path in found]
+    with get_cursor() as cur:
+        cur.execute(
+            """UPDATE files f SET "content_hash" = p."content_hash"
+               FROM unnest(%s::text[], %s::text[], %s::text[]) AS p("folder", "name", "content_hash")
+               WHERE f."repo" = %s AND f."folder" = p."folder" AND f."name" = p."name"
+            """,
+            ([folder for folder, _ in paths], [name for _, name in paths], list(found.values()), repo_name))
+
+
+def indexable(repo_path, path):
+    full_path = os.path.join(repo_path, path)
+    return (is_acceptable_file(os.path.basename(path)) and os.path.isfile(full_path)
+            and is_acceptable_folder(os.path.dirname(full_path)))
+
+
+def update_repo(repo_name, workers=INGEST_WORKERS):
+    """
+    Refreshes an indexed repository: files added or changed since the last
+    indexed commit and their ancestor folders are summarized again, rows of
+    deleted files and folders are removed, and everything else is kept.
+    """
+    repo_path = f"repos/{repo_name}"
+    if not os.path.exists(repo_path):
+        print(
+            f"Repository '{repo_name}' not found at expected path {repo_path}. Exiting...")
+        return
+
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "indexed_commit" FROM repos WHERE "name" = %s""", (repo_name,))
+        row = cur.fetchone()
+    indexed_commit = row[0] if row else None
+    create_partitions(repo_name)
+
+    stored = stored_hashes(repo_name)
+    found = {}
+    changes = changed_paths_since(
+        repo_path, indexed_commit) if indexed_commit else None
+    if changes is None:
+        print("No usable indexed commit, comparing content hashes...")
+        changes = changed_paths_by_hash(repo_path, stored, found)
+    else:
+        # Uncommitted changes show up in every diff against the indexed
+        # commit, and untracked files can disappear without one; only files
+        # not indexed as they are now need summaries
+        changed, _ = changes
+        changes = ({path for path in changed
+                    if indexable(repo_path, path) and not hash_matches(repo_path, path, stored, found)},
+                   {path for path in stored if not indexable(repo_path, path)})
+    store_hashes(repo_name, found)
+    changed, deleted = changes
+    print(f"Updating repository '{repo_name}': {len(changed)} changed, {len(deleted)} deleted paths.")
+    # Files indexed before file_chunks existed are chunked by process_file
+    if not changed and not deleted and not unchunked_files(repo_name):
+        insert_repo(repo_name, git_head(repo_path))
+        return
+
+    # Every folder on the way up from a changed path has a stale summary
+    stale_folders = {"."}
+    for path in changed | deleted:
+        folder = os.path.dirname(path)
+        while folder:
+            stale_folders.add(folder)
+            folder = os.path.dirname(folder)
+    existing_folders = {os.path.relpath(folder, repo_path)
+                        for folder in walk_tree(repo_path)}
+
+    files = [(os.path.dirname(path) or ".", os.path.basename(path))
+             for path in changed | deleted]
+    with get_cursor() as cur:
+        cur.execute(
+            """DELETE FROM files f USING unnest(%s::text[], %s::text[]) AS p("folder", "name")
+               WHERE f."repo" = %s AND f."folder" = p."folder" AND f."name" = p."name"
+            """,
+            ([folder for folder, _ in files], [name for _, name in files], repo_name))
+        cur.execute(
+            """DELETE FROM folders WHERE "repo" = %s AND ("name" = ANY(%s) OR NOT "name" = ANY(%s))""",
+            (repo_name, list(stale_folders), list(existing_folders)))
+
+    # Unchanged files and folders still have rows, so only the removed ones
+    # are summarized again
+    process_tree(repo_path, repo_name, workers)
+    print(completion_cache_summary())
+    backfill(repo_name)
+    print(latency_summary())
+    print(metrics.summary())
+    insert_repo(repo_name, git_head(repo_path))
+
+
+def main(repo_name, workers=INGEST_WORKERS, commits=False, max_commits=COMMIT_LOG_COUNT, commit_range=None):
     # Check if the repository has already been processed
-    cur.execute(
-        """SELECT "name" FROM repos WHERE "name" = %s""", (repo_name,))
-    row = cur.fetchone()
+    with get_cursor() as cur:
+        cur.execute(
+            """SELECT "name" FROM repos WHERE "name" = %s""", (repo_name,))
+        row = cur.fetchone()
     if row:
-        print(f"Repository '{repo_name}' already processed. Exiting...")
+        print(
+            f"Repository '{repo_name}' already processed. Use --incremental to update it. Exiting...")
         return
 
     # Validate the correct repo path
@@ -320,26 +745,48 @@ def main(repo_name):
             f"Repository '{repo_name}' not found at expected path {repo_path}. Exiting...")
         return
     print(f"Processing repository '{repo_name}'...")
+    create_partitions(repo_name)
 
-    # Walk through the directory tree
+    # Summarize the directory tree bottom-up
     print("Processing folders and files...")
-    for root, dirs, files in os.walk(repo_path, topdown=False):
-        dirs[:] = [d for d in dirs if is_acceptable_folder(d)]
-        process_folder(root, repo_path, repo_name)
+    process_tree(repo_path, repo_name, workers)
 
-    # Process commits
-    # print("Processing commits...")
-    # process_commits(repo_path, repo_name)
+    if commits:
+        print("Processing commits...")
+        process_commits(repo_path, repo_name, max_commits,
+                        commit_range, workers)
 
-    # insert_repo(repo_name)
+    print(completion_cache_summary())
 
     backfill(repo_name)
+    print(latency_summary())
+    print(metrics.summary())
+
+    insert_repo(repo_name, git_head(repo_path))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        main(sys.argv[1])
-        cur.close()
-        conn.close()
+    parser = argparse.ArgumentParser(
+        description="Summarize and embed a repository under repos/.")
+    parser.add_argument("repo")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Files, folders or commits summarized at once.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-summarize what changed since the last indexed commit.")
+    parser.add_argument("--commits", action="store_true",
+                        help="Also summarize the commit history.")
+    parser.add_argument("--max-commits", type=int, default=COMMIT_LOG_COUNT,
+                        help="Commits read from git log (-n).")
+    parser.add_argument("--commit-range", default=None,
+                        help="Revision range passed to git log, e.g. v1.0..HEAD.")
+    parser.add_argument("--drop", action="store_true",
+                        help="Remove everything indexed for the repository instead.")
+    args = parser.parse_args()
+    if args.drop:
+        drop_repo(args.repo)
+        print(f"Repository '{args.repo}' dropped.")
+    elif args.incremental:
+        update_repo(args.repo, args.workers)
     else:
-        print("Usage: python process_repo.py <repo>")
+        main(args.repo, args.workers, args.commits,
+             args.max_commits, args.commit_range)
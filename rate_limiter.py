@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import asyncio
+import inspect
+import functools
+import threading
+import httpx
+import openai
+import requests
+import metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+# Starting limits per provider, in requests and tokens per minute. Responses
+# carrying x-ratelimit-* headers replace them with the provider's own.
+RATE_LIMITS = {
+    "openai": (int(os.getenv("OPENAI_RPM", "5000")), int(os.getenv("OPENAI_TPM", "2000000"))),
+    "ubicloud": (int(os.getenv("UBICLOUD_RPM", "600")), int(os.getenv("UBICLOUD_TPM", "1000000"))),
+}
+# Attempts per call, and the cap on the jittered exponential backoff between
+# them, in seconds
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "6"))
+RATE_LIMIT_MAX_BACKOFF = float(os.getenv("RATE_LIMIT_MAX_BACKOFF", "60"))
+RATE_LIMIT_BASE_BACKOFF = 1.0
+# Statuses worth retrying: rate limited, timed out, or a server error
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class ProviderError(Exception):
+    """
+    An unsuccessful HTTP response from a provider, with its status and
+    headers, so rate limits can be told apart from bad requests.
+    """
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(f"Error: {status} - {message}")
+        self.status = status
+        self.headers = headers or {}
+
+
+class TokenBucket:
+    """
+    Holds up to `per_minute` units and refills at per_minute / 60 a second.
+    The level may go negative: a caller reserving more than is left is told
+    how long to wait, and callers after it wait behind it.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self.refill(now)
+        # A single call larger than the whole bucket waits for a full one
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level * 60 / self.capacity)
+
+
+class RateLimiter:
+    """
+    Paces the calls to one provider model by requests and tokens per minute.
+    """
+
+    def __init__(self, provider, model):
+        requests_per_minute, tokens_per_minute = RATE_LIMITS[provider]
+        self.labels = (("model", model), ("provider", provider))
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """
+        Takes one request and `tokens` tokens and returns how many seconds to
+        wait before sending the request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now),
+                        self.blocked_until - now)
+        if delay > 0:
+            metrics.observe("rate_limit_wait", self.labels, delay, {})
+        return delay
+
+    def update(self, headers):
+        """
+        Adopts the limits and remaining allowance reported in the
+        x-ratelimit-* headers of a response.
+        """
+        with self.lock:
+            now = time.monotonic()
+            for bucket, kind in [(self.requests, "requests"), (self.tokens, "tokens")]:
+                limit = header_number(headers, f"x-ratelimit-limit-{kind}")
+                if limit:
+                    bucket.refill(now)
+                    bucket.capacity = limit
+                remaining = header_number(headers, f"x-ratelimit-remaining-{kind}")
+                if remaining is not None:
+                    bucket.refill(now)
+                    bucket.level = min(bucket.level, remaining)
+
+    def back_off(self, attempt, headers):
+        """
+        Returns how long to wait before retrying a failed call. A Retry-After
+        header also holds back every other caller of this model for as long.
+        """
+        retry_after = retry_after_seconds(headers)
+        with self.lock:
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                self.requests.level = min(self.requests.level, 0)
+                return retry_after + random.uniform(0, RATE_LIMIT_BASE_BACKOFF)
+        # Full jitter keeps callers that failed together from retrying together
+        return random.uniform(0, min(RATE_LIMIT_MAX_BACKOFF, RATE_LIMIT_BASE_BACKOFF * 2 ** attempt))
+
+
+def get_limiter(provider, model):
+    key = (provider, model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(key, RateLimiter(provider, model))
+    return limiter
+
+
+def header_number(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def retry_after_seconds(headers):
+    milliseconds = header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    # Retry-After may also be an HTTP date, which is left to the backoff
+    return header_number(headers, "retry-after")
+
+
+def retryable(error):
+    """
+    Returns whether `error` is worth retrying, and the response headers that
+    came with it.
+    """
+    if isinstance(error, ProviderError):
+        return error.status in RETRY_STATUSES, error.headers
+    if isinstance(error, openai.APIStatusError):
+        # An exhausted quota is reported as a 429 too, but waiting won't help
+        if getattr(error, "code", None) == "insufficient_quota":
+            return False, {}
+        return error.status_code in RETRY_STATUSES, error.response.headers
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout,
+                          httpx.TransportError)):
+        return True, {}
+    return False, {}
+
+
+def limited(provider, model, tokens):
+    """
+    Decorates a provider call so that it waits for its share of `model`'s
+    rate limits, and is retried with jittered backoff when rate limited or
+    failing transiently. `tokens(*args)` estimates the tokens a call uses.
+    The call itself reports response headers with update(provider, model,
+    headers). Generators are retried only until they yield.
+    """
+    def decorate(fn):
+        limiter = get_limiter(provider, model)
+
+        def attempts(args):
+            for attempt in range(RATE_LIMIT_RETRIES):
+                yield attempt, limiter.reserve(tokens(*args))
+
+        def handle(error, attempt):
+            retry, headers = retryable(error)
+            if not retry or attempt == RATE_LIMIT_RETRIES - 1:
+                raise error
+            metrics.observe("provider_retry", limiter.labels, 0, {})
+            return limiter.back_off(attempt, headers)
+
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args):
+                for attempt, delay in attempts(args):
+                    await asyncio.sleep(delay)
+                    started = False
+                    try:
+                        async for item in fn(*args):
+                            started = True
+                            yield item
+                        return
+                    except Exception as e:
+                        if started:
+                            raise
+                        await asyncio.sleep(handle(e, attempt))
+        elif inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args):
+                for attempt, delay in attempts(args):
+                    time.sleep(delay)
+                    started = False
+                    try:
+                        for item in fn(*args):
+                            started = True
+                            yield item
+                        return
+                    except Exception as e:
+                        if started:
+                            raise
+                        time.sleep(handle(e, attempt))
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args):
+                for attempt, delay in attempts(args):
+                    await asyncio.sleep(delay)
+                    try:
+                        return await fn(*args)
+                    except Exception as e:
+                        await asyncio.sleep(handle(e, attempt))
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args):
+                for attempt, delay in attempts(args):
+                    time.sleep(delay)
+                    try:
+                        return fn(*args)
+                    except Exception as e:
+                        time.sleep(handle(e, attempt))
+        return wrapper
+    return decorate
+
+
+def update(provider, model, headers):
+    get_limiter(provider, model).update(headers)
@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+import threading
+import weakref
+import httpx
+import requests
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+UBICLOUD_CONNECT_TIMEOUT = float(os.getenv("UBICLOUD_CONNECT_TIMEOUT", "5"))
+# Seconds without receiving anything before a request is given up; a
+# completion of a large prompt can take a while to start
+UBICLOUD_READ_TIMEOUT = float(os.getenv("UBICLOUD_READ_TIMEOUT", "120"))
+# Keep-alive connections per endpoint, shared by all threads or tasks
+UBICLOUD_POOL_SIZE = int(os.getenv("UBICLOUD_POOL_SIZE", "16"))
+# Latencies kept per request kind for the percentiles
+LATENCY_SAMPLES = 1000
+
+_session = None
+_session_lock = threading.Lock()
+# httpx connections belong to the event loop that opened them
+_async_clients = weakref.WeakKeyDictionary()
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=UBICLOUD_POOL_SIZE,
+                                      pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UBICLOUD_READ_TIMEOUT, connect=UBICLOUD_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=UBICLOUD_POOL_SIZE,
+                                max_keepalive_connections=UBICLOUD_POOL_SIZE))
+        _async_clients[loop] = client
+    return client
+
+
+def record_latency(kind, seconds):
+    with _latencies_lock:
+        _latencies.setdefault(kind, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+
+def latency_stats():
+    """
+    Returns, per request kind, the number of recent requests and their mean,
+    median, 95th percentile and maximum latency in seconds.
+    """
+    with _latencies_lock:
+        samples = {kind: sorted(values) for kind, values in _latencies.items()}
+    return {kind: {"count": len(values),
+                   "mean": sum(values) / len(values),
+                   "p50": values[len(values) // 2],
+                   "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+                   "max": values[-1]}
+            for kind, values in samples.items() if values}
+
+
+def latency_summary():
+    return "\n".join(
+        f"Ubicloud {kind}: {stats['count']} requests, mean {stats['mean']:.2f}s, "
+        f"p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, max {stats['max']:.2f}s"
+        for kind, stats in sorted(latency_stats().items())) or "Ubicloud: no requests."
+
+
+def post(kind, url, **kwargs):
+    """
+    POSTs over the shared keep-alive session and records the latency under
+    `kind`.
+    """
+    started = time.monotonic()
+    try:
+        return get_session().post(url, timeout=(UBICLOUD_CONNECT_TIMEOUT, UBICLOUD_READ_TIMEOUT), **kwargs)
+    finally:
+        record_latency(kind, time.monotonic() - started)
+
+
+@contextmanager
+def post_stream(kind, url, **kwargs):
+    """
+    Like post, but for a streamed response, which is closed (and its latency
+    recorded) when the block exits.
+    """
+    started = time.monotonic()
+    try:
+        with get_session().post(url, timeout=(UBICLOUD_CONNECT_TIMEOUT, UBICLOUD_READ_TIMEOUT),
+                                stream=True, **kwargs) as response:
+            yield response
+    finally:
+        record_latency(kind, time.monotonic() - started)
+
+
+async def async_post(kind, url, **kwargs):
+    started = time.monotonic()
+    try:
+        return await get_async_client().post(url, **kwargs)
+    finally:
+        record_latency(kind, time.monotonic() - started)
+
+
+@asynccontextmanager
+async def async_post_stream(kind, url, **kwargs):
+    started = time.monotonic()
+    try:
+        async with get_async_client().stream("POST", url, **kwargs) as response:
+            yield response
+    finally:
+        record_latency(kind, time.monotonic() - started)
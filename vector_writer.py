@@ -0,0 +1,109 @@
+import io
+import struct
+import numpy as np
+import metrics
+from pgvector import Vector
+from psycopg2.extras import execute_values
+
+# Binary COPY framing: signature, flags and header extension length
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+
+
+def to_vector(values):
+    """
+    Converts an embedding (a list of floats from the provider APIs) into a
+    float32 array that the pgvector adapter can send without going through
+    json.dumps.
+    """
+    if values is None:
+        return None
+    return np.asarray(values, dtype=np.float32)
+
+
+def encode_copy_field(value):
+    if value is None:
+        return struct.pack(">i", -1)
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+    elif isinstance(value, int):
+        data = struct.pack(">i", value)
+    else:
+        data = Vector(value).to_binary()
+    return struct.pack(">i", len(data)) + data
+
+
+def copy_binary(cur, table, columns, rows):
+    """
+    Loads `rows` into `table` with COPY ... (FORMAT BINARY). Values must be
+    text, int (for integer columns), None, or vectors, which are sent in
+    pgvector's binary format.
+    """
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
+    for row in rows:
+        buffer.write(struct.pack(">h", len(row)))
+        for value in row:
+            buffer.write(encode_copy_field(value))
+    buffer.write(COPY_TRAILER)
+    metrics.add(bytes=buffer.tell())
+    buffer.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT BINARY)", buffer)
+
+
+def update_vectors(cur, table, key_columns, rows):
+    """
+    Sets vector_openai and vector_ubicloud on many rows of `table` at once.
+
+    `rows` are tuples of the values of `key_columns` followed by the two
+    vectors. They are copied in binary into a temporary staging table with
+    the columns' own types and applied with a single UPDATE ... FROM join.
+    If all rows share a repo, the UPDATE names it, so only that repo's
+    partition is planned and locked. The caller commits.
+    """
+    if not rows:
+        return
+    with metrics.span("db_update_vectors", table=table) as span:
+        span.add(rows=len(rows))
+        stage_and_update(cur, table, key_columns, rows)
+
+
+def stage_and_update(cur, table, key_columns, rows):
+    staging = f"{table}_vector_staging"
+    keys = [f'"{column}"' for column in key_columns]
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging} AS
+        SELECT {", ".join(keys)}, "vector_openai", "vector_ubicloud" FROM {table} WITH NO DATA""")
+    cur.execute(f"TRUNCATE {staging}")
+    copy_binary(cur, staging, keys + ['"vector_openai"', '"vector_ubicloud"'], rows)
+    conditions = [f"t.{key} = s.{key}" for key in keys]
+    params = None
+    if "repo" in key_columns:
+        repos = {row[key_columns.index("repo")] for row in rows}
+        if len(repos) == 1:
+            conditions.append('t."repo" = %s')
+            params = tuple(repos)
+    cur.execute(f"""
+        UPDATE {table} t
+        SET "vector_openai" = s."vector_openai", "vector_ubicloud" = s."vector_ubicloud"
+        FROM {staging} s
+        WHERE {" AND ".join(conditions)}""", params)
+
+
+def insert_rows(cur, table, columns, rows, conflict_columns, page_size=100):
+    """
+    Inserts many rows with multi-row VALUES statements, skipping rows whose
+    `conflict_columns` already exist. Vector values should be numpy arrays,
+    which the pgvector adapter registered on the connection sends as vectors.
+    The caller commits.
+    """
+    if not rows:
+        return
+    quoted = ", ".join(f'"{column}"' for column in columns)
+    conflict = ", ".join(f'"{column}"' for column in conflict_columns)
+    with metrics.span("db_insert", table=table) as span:
+        span.add(rows=len(rows))
+        execute_values(cur, f"""
+            INSERT INTO {table} ({quoted}) VALUES %s
+            ON CONFLICT ({conflict}) DO NOTHING""", rows, page_size=page_size)